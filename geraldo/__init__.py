@@ -16,6 +16,9 @@ It depends on ReportLab library to work.
 Packages Structure
 ------------------
 
+- aggregations.py - contains running aggregations, calculated while the
+  objects are rendered.
+
 - base.py - contains report base classes and definitions, including report,
   subreport, bands an groupping.
 
@@ -31,6 +34,8 @@ Packages Structure
 
 - graphics.py - contains graphic classes and definitions
 
+- jobs.py - contains the job queue to generate reports in background.
+
 - models.py - there is nothing. Just to be compatible with Django pluggable
   application structure and make possible run tests suite.
 
@@ -57,6 +62,7 @@ from widgets import FIELD_ACTION_VALUE, FIELD_ACTION_COUNT, FIELD_ACTION_AVG,\
         FIELD_ACTION_MIN, FIELD_ACTION_MAX, FIELD_ACTION_SUM,\
         FIELD_ACTION_DISTINCT_COUNT, BAND_WIDTH
 from graphics import RoundRect, Rect, Line, Circle, Arc, Ellipse, Image
-from exceptions import EmptyQueryset, ObjectNotFound, ManyObjectsFound, AbortEvent
+from exceptions import EmptyQueryset, ObjectNotFound, ManyObjectsFound, AbortEvent,\
+        StreamingError
 from cross_reference import CrossReferenceMatrix
 
@@ -0,0 +1,85 @@
+"""Running aggregations, updated object by object while the report is rendered.
+They are used to have aggregated values (sum, count, avg, etc.) available on group
+footers and summary bands without scan the objects list again."""
+
+try:
+    set
+except NameError:
+    from sets import Set as set
+
+import re
+
+from utils import FIELD_ACTION_COUNT, FIELD_ACTION_AVG, FIELD_ACTION_MIN,\
+        FIELD_ACTION_MAX, FIELD_ACTION_SUM, FIELD_ACTION_DISTINCT_COUNT
+
+AGGREGATION_ACTIONS = (FIELD_ACTION_COUNT, FIELD_ACTION_AVG, FIELD_ACTION_MIN,
+        FIELD_ACTION_MAX, FIELD_ACTION_SUM, FIELD_ACTION_DISTINCT_COUNT)
+
+# Finds aggregation functions in prepared expressions, like 'sum("amount")'
+EXP_AGGREGATIONS = re.compile('(%s)\("([^"]+)"'%'|'.join(AGGREGATION_ACTIONS))
+
+class RunningAggregate(object):
+    """Stores the running totals of the values fed to it, but only for the
+    informed actions (because i.e. strings can't be summed).
+
+    Attributes:
+
+        * length - count of fed values, including None ones
+        * count - count of fed values that are not None
+        * sum - sum of cleaned values (see argument 'clean')
+        * min, max - the lowest and highest fed values
+        * distinct - set with distinct values that are not None
+
+    The argument 'clean' is a function to clean values before summing them."""
+
+    actions = None
+    clean = None
+    length = 0
+    count = 0
+    sum = 0
+    min = None
+    max = None
+    distinct = None
+
+    def __init__(self, actions, clean=None):
+        self.actions = set(actions)
+        self.clean = clean
+
+        self._sums = FIELD_ACTION_SUM in self.actions or FIELD_ACTION_AVG in self.actions
+        self._limits = FIELD_ACTION_MIN in self.actions or FIELD_ACTION_MAX in self.actions
+
+        if FIELD_ACTION_DISTINCT_COUNT in self.actions:
+            self.distinct = set()
+
+    def feed(self, value):
+        # Lowest and highest values (keeping the first found, like min() and max())
+        if self._limits:
+            if not self.length:
+                self.min = self.max = value
+            elif value < self.min:
+                self.min = value
+            elif value > self.max:
+                self.max = value
+
+        self.length += 1
+
+        if value is not None:
+            self.count += 1
+
+            if self.distinct is not None:
+                self.distinct.add(value)
+
+        if self._sums:
+            if self.clean:
+                value = self.clean(value)
+
+            self.sum += value
+
+    def avg(self):
+        return self.sum / self.length
+
+def make_aggregate_key(widget, attribute_name):
+    """Running aggregates are stored by attribute name and widget settings that
+    change the way the values are got and cleaned"""
+    return (attribute_name, widget.converts_decimal_to_float, widget.converts_float_to_decimal,
+            widget.get_value)
@@ -1,16 +1,16 @@
-import copy, types, new
+import copy, types, new, itertools, os, tempfile, shutil
 
 try: 
     set 
 except NameError: 
     from sets import Set as set     # Python 2.3 fallback 
 
-from utils import calculate_size, get_attr_value, landscape, format_date, memoize,\
-        BAND_WIDTH, BAND_HEIGHT, CROSS_COLS, CROSS_ROWS, cm, A4, black, TA_LEFT, TA_CENTER,\
+from utils import calculate_size, resolve_size, get_attr_value, landscape, format_date, memoize,\
+        run_in_other_process, BAND_WIDTH, BAND_HEIGHT, CROSS_COLS, CROSS_ROWS, cm, A4, black, TA_LEFT, TA_CENTER,\
         TA_RIGHT
 from exceptions import EmptyQueryset, ObjectNotFound, ManyObjectsFound,\
         AttributeNotFound, NotYetImplemented
-from cache import DEFAULT_CACHE_STATUS, CACHE_BACKEND, CACHE_FILE_ROOT
+from cache import DEFAULT_CACHE_STATUS, CACHE_BACKEND, CACHE_FILE_ROOT, STREAM_CHUNK_SIZE
 
 class GeraldoObject(object):
     """Base class inherited by all report classes, including band, subreports,
@@ -161,6 +161,8 @@ class BaseReport(GeraldoObject):
     queryset = None
     print_if_empty = False # This means if a queryset is empty, the report will
                            # be generated or not
+    streaming = False # This means the objects are read one by one from the queryset
+                      # while rendering, instead of loaded all in memory before
 
     # Style and colors
     default_font_color = black
@@ -175,7 +177,11 @@ class BaseReport(GeraldoObject):
     on_new_page = None
 
     def __init__(self, queryset=None):
-        self.queryset = queryset or self.queryset
+        # On streaming mode the queryset is not evaluated to check if it is empty
+        if self.streaming and queryset is not None:
+            self.queryset = queryset
+        else:
+            self.queryset = queryset or self.queryset
 
         if self.queryset is None:
             self.queryset = []
@@ -217,13 +223,51 @@ class BaseReport(GeraldoObject):
     def get_objects_list(self):
         """Returns the list with objects to be rendered.
         
-        This should be refactored in the future to support big amounts of
-        objects."""
+        For big amounts of objects, set attribute 'streaming' as True and use
+        method 'get_objects_iterator' instead of this one."""
         if not self.queryset:
             return []
 
         return list(self.queryset)
 
+    def get_objects_iterator(self):
+        """Returns an iterator on the objects to be rendered.
+
+        If attribute 'streaming' is True, the objects are read one by one from the
+        queryset and are never stored together in memory. Django querysets are read
+        by their method 'iterator', that fetches rows in chunks and doesn't fill the
+        queryset cache. Otherwise it iterates the list from 'get_objects_list'."""
+        if not self.streaming:
+            return iter(self.get_objects_list())
+
+        if self.queryset is None:
+            return iter([])
+
+        if callable(getattr(self.queryset, 'iterator', None)):
+            return self.queryset.iterator()
+
+        return iter(self.queryset)
+
+    def has_objects(self):
+        """Returns True if the queryset has at least one object. On streaming
+        mode, it avoids to load the whole queryset just to check that."""
+        if self.streaming and callable(getattr(self.queryset, 'exists', None)):
+            return self.queryset.exists()
+
+        # Iterators are always true, so their first object is read and put back
+        if self.streaming and self.queryset is not None and\
+           iter(self.queryset) is self.queryset:
+            try:
+                first = self.queryset.next()
+            except StopIteration:
+                self.queryset = iter([])
+                return False
+
+            self.queryset = itertools.chain([first], self.queryset)
+            return True
+
+        return bool(self.queryset)
+
     def format_date(self, date, expression):
         """Use a date format string method to return formatted datetime.
 
@@ -340,6 +384,10 @@ class ReportMetaclass(type):
             default_style.update(attrs['default_style'])
             attrs['default_style'] = default_style
 
+        # Attributes relevant to the cache are found for each class (see
+        # geraldo.cache.get_report_cache_attributes)
+        attrs['_cache_attributes'] = None
+
         new_class = super(ReportMetaclass, cls).__new__(cls, name, bases, attrs)
 
         # Defines a registration ID
@@ -397,6 +445,7 @@ class Report(BaseReport):
     cache_backend = None
     cache_prefix = None
     cache_file_root = None
+    cache_backend_kwargs = None
 
     def __init__(self, queryset=None):
         super(Report, self).__init__(queryset)
@@ -415,10 +464,47 @@ class Report(BaseReport):
             self.cache_prefix = '-'.join([self.__class__.__module__, self.__class__.__name__])
         if self.cache_file_root is None:
             self.cache_file_root = CACHE_FILE_ROOT
+        self.cache_backend_kwargs = self.cache_backend_kwargs or {}
 
         # Calls the method that set this as parent if their children
         self.set_parent_on_children()
 
+        # Calculates size expressions (like '10*cm') just once
+        self.resolve_sizes()
+
+    def resolve_sizes(self):
+        """Replaces size expressions on report, bands and elements by their
+        calculated values, so generators don't have to parse them for each
+        rendered element. Expressions depending on generator (like '10*rows'
+        on text generator) and flags like BAND_WIDTH are kept as they are."""
+
+        def resolve_attrs(obj, attrs):
+            for attr in attrs:
+                value = getattr(obj, attr, None)
+                if isinstance(value, basestring):
+                    setattr(obj, attr, resolve_size(value))
+
+        resolve_attrs(self, ('margin_top','margin_bottom','margin_left','margin_right'))
+
+        if [size for size in self.page_size if isinstance(size, basestring)]:
+            self.page_size = tuple(map(resolve_size, self.page_size))
+
+        def resolve_children(obj):
+            try:
+                children = obj.get_children()
+            except (NotYetImplemented, AttributeError):
+                return
+
+            for child in children:
+                if isinstance(child, ReportBand):
+                    resolve_attrs(child, ('height','width'))
+                elif isinstance(child, Element):
+                    resolve_attrs(child, ('left','top','right','bottom','_width','_height'))
+
+                resolve_children(child)
+
+        resolve_children(self)
+
     def generate_by(self, generator_class, *args, **kwargs):
         """This method uses a generator inherited class to generate a report
         to a desired format, like XML, HTML or PDF, for example.
@@ -426,7 +512,7 @@ class Report(BaseReport):
         The arguments *args and **kwargs are passed to class initializer."""
 
         # Check empty queryset and raises an error if this is not acceptable
-        if not self.print_if_empty and not self.queryset:
+        if not self.print_if_empty and not self.has_objects():
             raise EmptyQueryset("This report doesn't accept empty queryset")
 
         # Initialize generator instance
@@ -436,45 +522,42 @@ class Report(BaseReport):
 
     def generate_under_process_by(self, generator_class, *args, **kwargs):
         """Uses the power of multiprocessing library to run report generation under
-        a Process and save memory consumming, with better use of multi-core servers.
+        a new process and save memory consumming, with better use of multi-core
+        servers.
+
+        Where processes are forked, the report is not pickled, so its queryset is
+        loaded by the new process, not by this one.
         
         This just will work well if you are generating in a destination file or
-        file-like object (i.e. an HttpResponse on Django).
+        file-like object (i.e. an HttpResponse on Django). The output generated
+        for a file-like object is written to a temporary file and copied to it in
+        chunks.
         
-        It doesn't returns nothing because Process doesn't."""
-
-        import tempfile, random, os
-        from utils import run_under_process
+        It doesn't returns nothing."""
 
         # Checks 'filename' argument
         if 'filename' in kwargs and not isinstance(kwargs['filename'], basestring):
-            # Stores file-like object
+            # Stores file-like object, and generates in a temporary file instead
             filelike = kwargs.pop('filename')
-
-            # Make a randomic temporary filename
-            chars = map(chr, range(ord('a'), ord('z')) + range(ord('0'), ord('9')))
-            filename = ''.join([random.choice(chars) for c in range(40)])
-            kwargs['filename'] = os.path.join(tempfile.gettempdir(), filename)
+            fd, kwargs['filename'] = tempfile.mkstemp(prefix='geraldo-')
+            os.close(fd)
         else:
             filelike = None
 
-        @run_under_process
-        def generate_report(report, generator_class, *args, **kwargs):
-            # Generate report into response object
-            report.generate_by(generator_class, *args, **kwargs)
-
-        # Run report generation
-        generate_report(self, generator_class, *args, **kwargs)
-
-        # Loads temp file
-        if filelike:
-            # Reads the temp file
-            fp = file(kwargs['filename'])
-            cont = fp.read()
-            fp.close()
+        try:
+            # Run report generation
+            run_in_other_process(generate_report, (self, generator_class) + args, kwargs)
 
-            # Writes temp file content in file-like object
-            filelike.write(cont)
+            # Copies the output to file-like object
+            if filelike:
+                fp = file(kwargs['filename'], 'rb')
+                try:
+                    shutil.copyfileobj(fp, filelike, STREAM_CHUNK_SIZE)
+                finally:
+                    fp.close()
+        finally:
+            if filelike:
+                os.remove(kwargs['filename'])
 
     def get_page_rect(self):
         """Calculates a dictionary with page dimensions inside the margins
@@ -517,6 +600,10 @@ class Report(BaseReport):
             for subreport in self.subreports:
                 subreport.parent = self
 
+def generate_report(report, generator_class, *args, **kwargs):
+    """Generates the report, called by 'generate_under_process_by' in a new process"""
+    report.generate_by(generator_class, *args, **kwargs)
+
 class SubReport(BaseReport):
     """Class to be used for subreport objects. It doesn't need to be inherited.
     
@@ -1,9 +1,10 @@
 """Caching functions file. You can use this stuff to store generated reports in a file
 system cache, and save time and performance."""
 
-import os
+import os, re, time, tempfile, socket, binascii, shutil
+from cStringIO import StringIO
 
-from utils import memoize, get_attr_value
+from utils import get_attr_getter, get_object_by_path, LRUCache, threading
 
 try:
     set
@@ -13,15 +14,120 @@ except:
 CACHE_DISABLED = 0
 CACHE_BY_QUERYSET = 1
 CACHE_BY_RENDER = 2
+CACHE_BY_PAGE = 3
 DEFAULT_CACHE_STATUS = CACHE_DISABLED
 
 CACHE_BACKEND = 'geraldo.cache.FileCacheBackend'
 CACHE_FILE_ROOT = '/tmp/'
+CACHE_FILE_MAX_BYTES = None
+CACHE_FILE_TIMEOUT = None
+CACHE_MEMORY_MAX_BYTES = 50 * 1024 * 1024
+CACHE_MEMCACHED_SERVERS = ['127.0.0.1:11211']
+CACHE_MEMCACHED_TIMEOUT = 0
+
+TEMP_FILE_PREFIX = '.geraldo-tmp-'
+LOCK_FILE_PREFIX = '.geraldo-lock-'
+
+# Size of chunks to copy streams from and to the cache
+STREAM_CHUNK_SIZE = 64 * 1024
+
+try:
+    # Python 2.5 or higher
+    from hashlib import md5 as md5_constructor
+except ImportError:
+    # Python 2.4
+    import md5
+    md5_constructor = md5.new
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Guards the dictionaries of locks by key
+if threading:
+    _key_locks_guard = threading.Lock()
+
+class KeyLock(object):
+    """A lock for a hash key, shared by the threads of the process. The locks are
+    kept in the dictionary 'locks' just while they are used."""
+
+    def __init__(self, locks, hash_key):
+        self.locks = locks
+        self.hash_key = hash_key
+
+    def acquire(self):
+        if not threading:
+            return
+
+        _key_locks_guard.acquire()
+        try:
+            entry = self.locks.setdefault(self.hash_key, [threading.Lock(), 0])
+            entry[1] += 1
+        finally:
+            _key_locks_guard.release()
+
+        entry[0].acquire()
+
+    def release(self):
+        if not threading:
+            return
+
+        _key_locks_guard.acquire()
+        try:
+            entry = self.locks[self.hash_key]
+            entry[0].release()
+
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[self.hash_key]
+        finally:
+            _key_locks_guard.release()
+
+class FileLock(object):
+    """A lock for a hash key shared by processes, using 'flock' on a lock file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def acquire(self):
+        while True:
+            fp = file(self.path, 'a')
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+
+            # The lock file is removed on release, so it can be another file now,
+            # if this one waited for it
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                stat = None
+
+            fstat = os.fstat(fp.fileno())
+            if stat is not None and (stat.st_dev, stat.st_ino) == (fstat.st_dev, fstat.st_ino):
+                self.file = fp
+                return
+
+            fp.close()
+
+    def release(self):
+        # The lock file is removed while it is still locked, so lock files don't
+        # pile up in the cache directory
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
 
 class BaseCacheBackend(object):
     """This is the base class (and abstract too) to be inherited by any cache backend
     to store and restore reports from a cache."""
 
+    _locks = None
+
     def get(self, hash_key):
         pass
 
@@ -31,50 +137,448 @@ class BaseCacheBackend(object):
     def exists(self, hash_key):
         pass
 
+    def delete(self, hash_key):
+        pass
+
+    def get_stream(self, hash_key):
+        """Returns a file object to read the content from, or None. Backends able to
+        read in chunks should override this to avoid loading the whole content."""
+        content = self.get(hash_key)
+        if content is None:
+            return None
+
+        return StringIO(content)
+
+    def set_stream(self, hash_key, fp):
+        """Stores the content read from the file object. Backends able to write in
+        chunks should override this to avoid loading the whole content."""
+        return self.set(hash_key, fp.read())
+
+    def lock(self, hash_key):
+        """Returns a lock for the hash key, used by generators to make just one of
+        them generate a report while the others wait to get it from the cache. The
+        default one is shared by threads of the process."""
+        if self._locks is None:
+            self._locks = {}
+
+        return KeyLock(self._locks, hash_key)
+
 class FileCacheBackend(BaseCacheBackend):
-    """This cache backend is able to store and restore using a path on the file system."""
+    """This cache backend is able to store and restore using a path on the file system.
+
+    Files are stored in subdirectories named by the first characters of the md5 of
+    their hash keys, and are written to a temporary file renamed at the end, so
+    readers never see half-written files.
+
+    If 'max_bytes' is set, the least recently read files are removed when the
+    total size of the cache exceeds it. If 'timeout' (in seconds) is set, files
+    older than it are ignored and removed. Files are not scanned on every write,
+    but when the size known since the last scan exceeds 'max_bytes', or after
+    'cull_interval' seconds (see 'cull_if_needed')."""
 
     cache_file_root = '/tmp/'
+    max_bytes = CACHE_FILE_MAX_BYTES
+    timeout = CACHE_FILE_TIMEOUT
+    shard_length = 2
+    cull_interval = 60
+
+    _known_size = None # Total size found by the last scan plus the bytes written since
+    _culled_at = 0
 
-    def __init__(self, cache_file_root=None):
+    def __init__(self, cache_file_root=None, max_bytes=None, timeout=None):
         self.cache_file_root = cache_file_root or self.cache_file_root
 
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        if timeout is not None:
+            self.timeout = timeout
+
+        self.hits = self.misses = self.evictions = 0
+
         # Creates the directory if doesn't exists
         if not os.path.exists(self.cache_file_root):
             os.makedirs(self.cache_file_root)
 
+    def get_file_path(self, hash_key):
+        """Returns the file path for a hash key, inside its shard directory"""
+        shard = md5_constructor(hash_key).hexdigest()[:self.shard_length]
+        return os.path.join(self.cache_file_root, shard, hash_key)
+
+    def is_expired(self, stat, now=None):
+        if not self.timeout:
+            return False
+
+        return (now or time.time()) - stat.st_mtime > self.timeout
+
     def get(self, hash_key):
-        # Returns None if doesn't exists
-        if not self.exists(hash_key):
+        fp = self.get_stream(hash_key)
+        if fp is None:
             return None
 
         # Returns the file content
-        fp = file(os.path.join(self.cache_file_root, hash_key), 'rb')
-        content = fp.read()
-        fp.close()
+        try:
+            return fp.read()
+        finally:
+            fp.close()
+
+    def get_stream(self, hash_key):
+        """Returns the opened file, to be read in chunks"""
+        path = self.get_file_path(hash_key)
+
+        # Returns None if doesn't exists (or was removed by other process)
+        try:
+            if self.is_expired(os.stat(path)):
+                self.remove_file(path)
+                raise OSError(path)
+
+            fp = file(path, 'rb')
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+
+        # Access time is used to know the least recently used files
+        try:
+            os.utime(path, (time.time(), os.fstat(fp.fileno()).st_mtime))
+        except OSError:
+            pass
+
+        self.hits += 1
+        return fp
+
+    def set(self, hash_key, content):
+        self.set_stream(hash_key, StringIO(content))
+
+    def set_stream(self, hash_key, fp):
+        """Copies the file object content in chunks to the cache file"""
+        path = self.get_file_path(hash_key)
+        directory = os.path.dirname(path)
+
+        self.make_directory(directory)
+
+        # Writes the content in a temporary file and renames it to the final path
+        fd, temp_path = tempfile.mkstemp(prefix=TEMP_FILE_PREFIX, dir=directory)
+        try:
+            temp_fp = os.fdopen(fd, 'wb')
+            try:
+                shutil.copyfileobj(fp, temp_fp, STREAM_CHUNK_SIZE)
+                size = temp_fp.tell()
+            finally:
+                temp_fp.close()
+
+            # Same clock used to update access time on reads
+            now = time.time()
+            os.utime(temp_path, (now, now))
+
+            try:
+                os.rename(temp_path, path)
+            except OSError:
+                # Windows doesn't replace existing files on rename
+                self.remove_file(path)
+                os.rename(temp_path, path)
+        except:
+            self.remove_file(temp_path)
+            raise
+
+        if self.max_bytes or self.timeout:
+            self.cull_if_needed(size)
+
+    def lock(self, hash_key):
+        """Returns a lock shared also by other processes, using a lock file"""
+        if not fcntl:
+            return super(FileCacheBackend, self).lock(hash_key)
+
+        path = self.get_file_path(hash_key)
+        self.make_directory(os.path.dirname(path))
+
+        return FileLock(os.path.join(os.path.dirname(path), LOCK_FILE_PREFIX + hash_key))
+
+    def exists(self, hash_key):
+        try:
+            return not self.is_expired(os.stat(self.get_file_path(hash_key)))
+        except OSError:
+            return False
+
+    def delete(self, hash_key):
+        self.remove_file(self.get_file_path(hash_key))
+
+    def make_directory(self, directory):
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by other process
+                if not os.path.isdir(directory):
+                    raise
+
+    def remove_file(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def get_cached_files(self):
+        """Returns a list of tuples (atime, size, path, stat) for the stored files"""
+        files = []
+
+        for dirpath, dirnames, filenames in os.walk(self.cache_file_root):
+            for filename in filenames:
+                if filename.startswith(TEMP_FILE_PREFIX) or filename.startswith(LOCK_FILE_PREFIX):
+                    continue
+
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                files.append((stat.st_atime, stat.st_size, path, stat))
+
+        return files
+
+    def cull_if_needed(self, written):
+        """Calls 'cull' when the size known since the last one, plus the bytes
+        written since, exceeds 'max_bytes', or 'cull_interval' seconds after the
+        last one (other processes can write to the same directory, and files expire)"""
+        if self._known_size is not None:
+            self._known_size += written
+
+        if self._known_size is None or time.time() - self._culled_at > self.cull_interval or\
+           (self.max_bytes and self._known_size > self.max_bytes):
+            self.cull()
+
+    def cull(self):
+        """Removes the expired files and, if the cache is bigger than 'max_bytes',
+        the least recently used ones until it fits. This scans all the files."""
+        now = time.time()
+        files = []
+        total = 0
+
+        for atime, size, path, stat in self.get_cached_files():
+            if self.is_expired(stat, now):
+                self.remove_file(path)
+                self.evictions += 1
+            else:
+                files.append((atime, size, path))
+                total += size
+
+        if self.max_bytes and total > self.max_bytes:
+            files.sort()
+            for atime, size, path in files:
+                self.remove_file(path)
+                self.evictions += 1
+
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+        self._known_size = total
+        self._culled_at = now
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+class MemoryCacheBackend(BaseCacheBackend):
+    """This cache backend stores the content in the process memory, discarding the
+    least recently used ones when their total size exceeds 'max_bytes'."""
+
+    max_bytes = CACHE_MEMORY_MAX_BYTES
+
+    def __init__(self, max_bytes=None, **kwargs):
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+
+        self._cache = LRUCache(max_size=self.max_bytes, get_size=len)
+
+    def get(self, hash_key):
+        return self._cache.get(hash_key)
+
+    def set(self, hash_key, content):
+        return self._cache.set(hash_key, content)
+
+    def exists(self, hash_key):
+        return hash_key in self._cache
+
+    def delete(self, hash_key):
+        self._cache.delete(hash_key)
+
+    def get_stats(self):
+        return {'hits': self._cache.hits, 'misses': self._cache.misses,
+                'evictions': self._cache.evictions}
+
+MEMCACHED_MAX_KEY_LENGTH = 250
+
+class MemcachedError(Exception):
+    pass
+
+class MemcachedCacheBackend(BaseCacheBackend):
+    """This cache backend stores the content in memcached servers, talking their
+    text protocol. Keys are distributed to the servers by their hashes.
+
+    Failures on connection are counted as errors and the cache is just ignored,
+    so the reports are generated as if there was no cache."""
+
+    servers = CACHE_MEMCACHED_SERVERS
+    timeout = CACHE_MEMCACHED_TIMEOUT
+    socket_timeout = 3
+
+    def __init__(self, servers=None, timeout=None, socket_timeout=None, **kwargs):
+        if servers is not None:
+            self.servers = servers
+        if timeout is not None:
+            self.timeout = timeout
+        if socket_timeout is not None:
+            self.socket_timeout = socket_timeout
+
+        self.hits = self.misses = self.errors = 0
+        self._connections = {}
+
+        if threading:
+            self._lock = threading.Lock()
+        else:
+            self._lock = None
+
+    def make_key(self, hash_key):
+        """Memcached doesn't support long keys nor with spaces or control chars"""
+        if isinstance(hash_key, unicode):
+            hash_key = hash_key.encode('utf-8')
+
+        if len(hash_key) > MEMCACHED_MAX_KEY_LENGTH or re.search(r'[\x00-\x20\x7f]', hash_key):
+            hash_key = md5_constructor(hash_key).hexdigest()
+
+        return hash_key
+
+    def get_server(self, key):
+        return self.servers[(binascii.crc32(key) & 0xffffffff) % len(self.servers)]
+
+    def get_connection(self, server):
+        if server not in self._connections:
+            host, port = server.rsplit(':', 1)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(self.socket_timeout)
+            sock.connect((host, int(port)))
+            self._connections[server] = (sock, sock.makefile('rb'))
+
+        return self._connections[server]
+
+    def close(self):
+        for server in self._connections.keys():
+            self.close_connection(server)
+
+    def close_connection(self, server):
+        sock, fp = self._connections.pop(server, (None, None))
+        if sock:
+            try:
+                fp.close()
+                sock.close()
+            except socket.error:
+                pass
+
+    def send_command(self, key, command, read_response):
+        """Sends the command to the server of the key and returns the response
+        read by function 'read_response'. Returns None if fails."""
+        server = self.get_server(key)
+
+        if self._lock: self._lock.acquire()
+        try:
+            try:
+                sock, fp = self.get_connection(server)
+                sock.sendall(command)
+                return read_response(fp)
+            except (socket.error, MemcachedError):
+                self.close_connection(server)
+                self.errors += 1
+                return None
+        finally:
+            if self._lock: self._lock.release()
+
+    def read_line(self, fp):
+        line = fp.readline()
+        if not line.endswith('\r\n'):
+            raise MemcachedError('Connection closed')
+        return line[:-2]
+
+    def read_value(self, fp):
+        line = self.read_line(fp)
+        if line == 'END':
+            return None
+        elif not line.startswith('VALUE '):
+            raise MemcachedError(line)
+
+        length = int(line.split()[3])
+        content = fp.read(length + 2)[:-2]
+        if len(content) != length or self.read_line(fp) != 'END':
+            raise MemcachedError('Invalid value')
+
+        return content
+
+    def get(self, hash_key):
+        key = self.make_key(hash_key)
+        content = self.send_command(key, 'get %s\r\n'%key, self.read_value)
+
+        if content is None:
+            self.misses += 1
+        else:
+            self.hits += 1
 
         return content
 
     def set(self, hash_key, content):
-        # Writes the content in the file
-        fp = file(os.path.join(self.cache_file_root, hash_key), 'wb')
-        fp.write(content)
-        fp.close()
+        key = self.make_key(hash_key)
+        command = 'set %s 0 %d %d\r\n%s\r\n'%(key, self.timeout, len(content), content)
+
+        # Responses like "SERVER_ERROR object too large for cache" just mean the
+        # content is not stored
+        return self.send_command(key, command, self.read_line) == 'STORED'
 
     def exists(self, hash_key):
-        return os.path.exists(os.path.join(self.cache_file_root, hash_key))
+        return self.get(hash_key) is not None
 
-@memoize
-def get_report_cache_attributes(report):
-    from widgets import ObjectValue
+    def delete(self, hash_key):
+        key = self.make_key(hash_key)
+        return self.send_command(key, 'delete %s\r\n'%key, self.read_line) == 'DELETED'
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'errors': self.errors}
 
-    # Find widgets attributes
-    widgets = [widget.attribute_name for widget in report.find_by_type(ObjectValue)]
+def get_report_cache_attributes(report):
+    """Returns the names of object attributes used by the report (in widgets and
+    groups), sorted. They are found just once for each report class, and stored
+    in its attribute '_cache_attributes' (reset by ReportMetaclass for each new
+    class). Reports changing their elements for each instance should have the
+    method 'get_cache_relevant_attributes'."""
+    report_class = report.__class__
+    if report_class._cache_attributes is None:
+        report_class._cache_attributes = find_report_cache_attributes(report)
+
+    return report_class._cache_attributes
+
+def find_report_cache_attributes(report):
+    from widgets import ObjectValue, get_expression_tokens
+    from exceptions import NotYetImplemented
+
+    names = set()
+
+    # Find widgets attributes (the ones used by expressions like 'price * quantity'
+    # are split)
+    objects = [report]
+    while objects:
+        try:
+            children = objects.pop().get_children()
+        except (NotYetImplemented, AttributeError):
+            continue
+
+        for child in children:
+            if isinstance(child, ObjectValue) and child.attribute_name:
+                names.update(get_expression_tokens(child.attribute_name) or [child.attribute_name])
+
+            objects.append(child)
 
     # Find grouppers attributes
-    groups = [group.attribute_name for group in report.groups]
+    names.update([group.attribute_name for group in report.groups if group.attribute_name])
 
-    return list(set(widgets + groups))
+    names = list(names)
+    names.sort()
+    return names
 
 try:
     # Python 2.5 or higher
@@ -84,7 +588,7 @@ except ImportError:
     import sha
     hash_constructor = sha.new
 
-def make_hash_key(report, objects_list):
+def make_hash_key(report, objects_list, fingerprint=None):
     """This function make a hash key from a list of objects.
     
     Situation 1
@@ -104,12 +608,22 @@ def make_hash_key(report, objects_list):
     If the method above does't exists, then all attributes explicitly found in report
     elements will be used.
     
-    The result list will be transformed to a long concatenated string and a hash key
-    will be generated from it."""
+    The string of each object is sent to the hash object as soon as it is made, so
+    the objects strings are never joined in memory.
+
+    Situation 3
+    -----------
+
+    If a 'fingerprint' is informed (a cheap value that changes when the objects
+    change, like their count and the latest modification date), the hash key is
+    made from its repr, and the objects list is not read."""
 
-    global get_report_cache_attributes
+    m = hash_constructor()
 
-    result = []
+    # Situation 3 - the fingerprint replaces the objects
+    if fingerprint is not None:
+        m.update('fingerprint:' + repr(fingerprint))
+        return '%s-%s'%(report.cache_prefix, m.hexdigest())
 
     # Get attributes for cache from report
     if hasattr(report, 'get_cache_relevant_attributes'):
@@ -117,26 +631,47 @@ def make_hash_key(report, objects_list):
     else:
         report_attrs = lambda: get_report_cache_attributes(report)
 
+    getters = None
+    separator = ''
+
     for obj in objects_list:
         # Situation 1 - mostly report pages and geraldo objects
         if hasattr(obj, 'repr_for_cache_hash_key'):
-            result.append(obj.repr_for_cache_hash_key())
+            value = obj.repr_for_cache_hash_key()
 
         # Situation 2 - mostly queryset objects list
         else:
-            result.append(u'/'.join([unicode(get_attr_value(obj, attr)) for attr in report_attrs()]))
+            if getters is None:
+                getters = [get_attr_getter(attr) for attr in report_attrs()]
 
-    # Makes the hash key
-    m = hash_constructor()
-    m.update(u'\n'.join(result))
+            value = u'/'.join([unicode(getter(obj)) for getter in getters])
+
+        # Updates the hash key with the object string
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        m.update(separator + value)
+        separator = '\n'
 
     return '%s-%s'%(report.cache_prefix, m.hexdigest())
 
+# Cache backends instances, shared by generators in the same process
+_cache_backends = {}
+
 def get_cache_backend(class_path, **kwargs):
-    """This method initializes the cache backend from string path informed."""
-    parts = class_path.split('.')
-    module = __import__('.'.join(parts[:-1]), fromlist=[parts[-1]])
-    cls = getattr(module, parts[-1])
+    """This method initializes the cache backend from string path informed.
+
+    The backend is instantiated once for each process and arguments (compared
+    by their repr, so lists like memcached 'servers' are accepted), and shared
+    by the next calls. If 'class_path' is already a backend instance,
+    it is just returned."""
+    if not isinstance(class_path, basestring):
+        return class_path
+
+    key = (os.getpid(), class_path, repr(sorted(kwargs.items())))
+    backend = _cache_backends.get(key, None)
 
-    return cls(**kwargs)
+    if backend is None:
+        cls = get_object_by_path(class_path)
+        backend = _cache_backends[key] = cls(**kwargs)
 
+    return backend
@@ -12,7 +12,7 @@ from reportlab.graphics.charts.spider import SpiderChart as OriginalSpiderChart
 from reportlab.graphics.charts.legends import Legend
 from reportlab.lib.colors import HexColor, getAllNamedColors
 
-from utils import cm, memoize, get_attr_value
+from utils import cm, memoize, get_attr_getter
 from cross_reference import CrossReferenceMatrix, CROSS_COLS, CROSS_ROWS
 from graphics import Graphic
 
@@ -244,7 +244,7 @@ class BaseChart(Graphic):
 
             # Transforms data to cross-reference matrix
             if isinstance(data, basestring):
-                data = get_attr_value(self.instance, data)
+                data = get_attr_getter(data)(self.instance)
 
             if not isinstance(data, CrossReferenceMatrix):
                 if self.rows_attribute: # and self.cols_attribute:
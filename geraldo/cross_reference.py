@@ -6,7 +6,7 @@ except:
     from sets import Set as set
 
 import random, decimal
-from utils import get_attr_value, memoize
+from utils import get_attr_getter, memoize
 from base import ReportBand, GeraldoObject, CROSS_COLS, CROSS_ROWS
 
 RANDOM_ROW_DEFAULT = RANDOM_COL_DEFAULT = ''.join([random.choice([chr(c) for c in range(48, 120)]) for i in range(100)])
@@ -30,6 +30,92 @@ class CrossReferenceProxy(object):
         raise AttributeError()
 
 
+class CrossReferenceBucket(object):
+    """Stores the values of a cell attribute for a row/col relation and their
+    statistics, calculated while the values are added, in the objects list order.
+
+    Buckets for all rows and/or all cols are merged from the row/col ones, keeping
+    just the statistics ('values' is None)."""
+
+    def __init__(self, keep_values=True):
+        self.values = keep_values and [] or None
+        self.count = 0
+        self.sum = 0
+        self.float_sum = 0
+        self.min = self.max = self.first = self.last = None
+        self.first_position = self.last_position = None
+
+    def add(self, value, position):
+        """Adds the value of the object in the position of the objects list"""
+        if self.values is not None:
+            self.values.append(value)
+
+        if not self.count:
+            self.min = self.max = self.first = value
+            self.first_position = position
+        elif value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+
+        self.last = value
+        self.last_position = position
+        self.count += 1
+
+        # Values that can't be summed are just summed again when requested,
+        # to raise the right exception
+        if self.sum is not None:
+            try:
+                self.sum += value
+            except TypeError:
+                self.sum = None
+
+        if self.float_sum is not None:
+            try:
+                self.float_sum += float(value)
+            except (TypeError, ValueError):
+                self.float_sum = None
+
+    def merge(self, other):
+        """Adds the statistics of other bucket, keeping first and last values by
+        their positions in the objects list"""
+        if not other.count:
+            return
+
+        if not self.count:
+            self.min, self.max = other.min, other.max
+            self.first, self.first_position = other.first, other.first_position
+            self.last, self.last_position = other.last, other.last_position
+            self.count, self.sum, self.float_sum = other.count, other.sum, other.float_sum
+            return
+
+        if other.min < self.min:
+            self.min = other.min
+        if other.max > self.max:
+            self.max = other.max
+
+        if other.first_position < self.first_position:
+            self.first, self.first_position = other.first, other.first_position
+        if other.last_position > self.last_position:
+            self.last, self.last_position = other.last, other.last_position
+
+        self.count += other.count
+
+        if self.sum is not None and other.sum is not None:
+            try:
+                self.sum += other.sum
+            except TypeError:
+                self.sum = None
+        else:
+            self.sum = None
+
+        if self.float_sum is not None and other.float_sum is not None:
+            self.float_sum += other.float_sum
+        else:
+            self.float_sum = None
+
+EMPTY_BUCKET = CrossReferenceBucket()
+
 class CrossReferenceMatrix(object):
     """Encapsulates an objects list and stores the X (rows) and Y (cols) attributes to make
     cross reference matrix, or just to make the calculations required.
@@ -44,9 +130,10 @@ class CrossReferenceMatrix(object):
     cols_attr = None
     cols_values = None
     decimal_as_float = False
+    indexed = True
 
     def __init__(self, objects_list, rows_attribute, cols_attribute, decimal_as_float=None,
-            rows_values=None, cols_values=None):
+            rows_values=None, cols_values=None, indexed=None):
         self.objects_list = list(objects_list) or []
         self.rows_attr = rows_attribute
         self.cols_attr = cols_attribute
@@ -56,6 +143,9 @@ class CrossReferenceMatrix(object):
         if decimal_as_float is not None:
             self.decimal_as_float = decimal_as_float
 
+        if indexed is not None:
+            self.indexed = indexed
+
     def __iter__(self):
         for row in self.rows():
             yield CrossReferenceProxy(self, row)
@@ -63,7 +153,7 @@ class CrossReferenceMatrix(object):
     def get_attr_value(self, obj, attr):
         """Returns the attribute value on an object, and converts decimal to float if necessary."""
 
-        value = get_attr_value(obj, attr)
+        value = get_attr_getter(attr)(obj)
         
         if isinstance(value, decimal.Decimal) and self.decimal_as_float:
             value = float(value)
@@ -79,7 +169,7 @@ class CrossReferenceMatrix(object):
     @memoize
     def rows(self):
         if self.rows_values is None:
-            self.rows_values = list(set([self.get_attr_value(obj, self.rows_attr) for obj in self.objects_list]))
+            self.rows_values = list(set([row for row, col in self.get_objects_rows_cols()]))
 
             # Sort list by method
             self.rows_values.sort(self.sort_rows)
@@ -89,7 +179,7 @@ class CrossReferenceMatrix(object):
     @memoize
     def cols(self):
         if self.cols_values is None:
-            self.cols_values = list(set([self.get_attr_value(obj, self.cols_attr) for obj in self.objects_list]))
+            self.cols_values = list(set([col for row, col in self.get_objects_rows_cols()]))
 
             # Sort list by method
             self.cols_values.sort(self.sort_cols)
@@ -97,33 +187,114 @@ class CrossReferenceMatrix(object):
         return self.cols_values
 
     @memoize
-    def values(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
-        """Receives the cell, row and col values and make the cross reference among them."""
+    def get_objects_rows_cols(self):
+        """Returns a list with (row, col) values for each object, in the same order"""
+        return [(self.get_attr_value(obj, self.rows_attr), self.get_attr_value(obj, self.cols_attr))
+                for obj in self.objects_list]
+
+    @memoize
+    def get_index(self, cell):
+        """Groups the cell values into buckets by (row, col) keys, in just one pass
+        on the objects list. Returns None if the index is disabled or row/col values
+        are not hashable."""
+        if not self.indexed:
+            return None
+
+        index = {}
+
+        try:
+            for position, (obj, key) in enumerate(zip(self.objects_list, self.get_objects_rows_cols())):
+                try:
+                    bucket = index[key]
+                except KeyError:
+                    bucket = index[key] = CrossReferenceBucket()
+
+                bucket.add(self.get_attr_value(obj, cell), position)
+        except TypeError:
+            return None
+
+        return index
+
+    @memoize
+    def get_merged_bucket(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
+        """Returns a bucket with the statistics of the row/col buckets for all rows
+        and/or all cols"""
+        bucket = CrossReferenceBucket(keep_values=False)
+
+        for (bucket_row, bucket_col), row_col_bucket in self.get_index(cell).items():
+            if (row == RANDOM_ROW_DEFAULT or bucket_row == row) and\
+               (col == RANDOM_COL_DEFAULT or bucket_col == col):
+                bucket.merge(row_col_bucket)
+
+        return bucket
+
+    def get_bucket(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
+        """Returns the bucket with statistics for the cell, row and col or None if
+        there is no index to find it. Just the buckets for a row and a col have the
+        values."""
+        index = self.get_index(cell)
+        if index is None:
+            return None
+
+        if row == RANDOM_ROW_DEFAULT or col == RANDOM_COL_DEFAULT:
+            return self.get_merged_bucket(cell, row, col)
+
+        try:
+            return index.get((row, col), EMPTY_BUCKET)
+        except TypeError:
+            return None
+
+    @memoize
+    def scan_values(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
+        """Returns the cell values for the row and col scanning the whole objects list"""
 
         return [self.get_attr_value(obj, cell) for obj in self.objects_list
             if (row == RANDOM_ROW_DEFAULT or self.get_attr_value(obj, self.rows_attr) == row) and
                (col == RANDOM_COL_DEFAULT or self.get_attr_value(obj, self.cols_attr) == col)]
 
-    @memoize
+    def values(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
+        """Receives the cell, row and col values and make the cross reference among them.
+        Returns a new list, so changing it doesn't change the matrix."""
+        bucket = self.get_bucket(cell, row, col)
+        if bucket is None or bucket.values is None:
+            return list(self.scan_values(cell, row, col))
+
+        return list(bucket.values)
+
     def max(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
-        values = self.values(cell, row, col)
+        bucket = self.get_bucket(cell, row, col)
+        if bucket is not None:
+            return bucket.count and bucket.max or None
+
+        values = self.scan_values(cell, row, col)
         return values and max(values) or None
 
-    @memoize
     def min(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
-        values = self.values(cell, row, col)
+        bucket = self.get_bucket(cell, row, col)
+        if bucket is not None:
+            return bucket.count and bucket.min or None
+
+        values = self.scan_values(cell, row, col)
         return values and min(values) or None
 
-    @memoize
     def sum(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
+        bucket = self.get_bucket(cell, row, col)
+        if bucket is not None and bucket.sum is not None:
+            return bucket.sum
+
+        # Values that can't be summed raise the right exception
         return sum(self.values(cell, row, col))
 
-    @memoize
     def avg(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
-        values = map(float, self.values(cell, row, col))
+        bucket = self.get_bucket(cell, row, col)
+        if bucket is not None and bucket.float_sum is not None:
+            length, total = bucket.count, bucket.float_sum
+        else:
+            values = map(float, self.values(cell, row, col))
+            length, total = len(values), sum(values)
 
         if row == RANDOM_ROW_DEFAULT and col == RANDOM_COL_DEFAULT:
-            count = len(values)
+            count = length
         elif row == RANDOM_ROW_DEFAULT:
             count = len(self.rows())
         elif col == RANDOM_COL_DEFAULT:
@@ -131,33 +302,39 @@ class CrossReferenceMatrix(object):
         else:
             count = len(self.rows()) * len(self.cols())
 
-        return values and sum(values) / count or None
+        return length and total / count or None
 
-    @memoize
     def count(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
-        return len(self.values(cell, row, col))
+        bucket = self.get_bucket(cell, row, col)
+        if bucket is not None:
+            return bucket.count
+
+        return len(self.scan_values(cell, row, col))
 
-    @memoize
     def distinct_count(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
         return len(set(self.values(cell, row, col)))
 
-    @memoize
     def percent(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
         total = self.sum(cell)
-        values = self.values(cell, row, col)
-        return total and (sum(values) / total * 100) or None
+        return total and (self.sum(cell, row, col) / total * 100) or None
 
-    @memoize
     def first(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
+        bucket = self.get_bucket(cell, row, col)
+        if bucket is not None:
+            return bucket.first
+
         try:
-            return self.values(cell, row, col)[0]
+            return self.scan_values(cell, row, col)[0]
         except IndexError:
             return None
 
-    @memoize
     def last(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
+        bucket = self.get_bucket(cell, row, col)
+        if bucket is not None:
+            return bucket.last
+
         try:
-            return self.values(cell, row, col)[-1]
+            return self.scan_values(cell, row, col)[-1]
         except IndexError:
             return None
 
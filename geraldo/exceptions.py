@@ -13,6 +13,16 @@ class AttributeNotFound(Exception):
 class NotYetImplemented(Exception):
     pass
 
+class WorkerError(Exception):
+    """Exception class raised when a function run under other process fails, with
+    the traceback of that process"""
+    pass
+
+class StreamingError(Exception):
+    """Exception class raised when the objects would have to be read again on
+    streaming mode, that reads them just once"""
+    pass
+
 class AbortEvent(Exception):
     """Exception class used inside event methods to abort that printing/rendering"""
     pass
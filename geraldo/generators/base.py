@@ -1,20 +1,123 @@
-import random, shelve, os
+import random, shelve, os, tempfile, types, shutil
 from decimal import Decimal
 
-from geraldo.utils import get_attr_value, calculate_size, memoize
-from geraldo.widgets import Widget, Label, SystemField
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from geraldo.utils import get_attr_getter, calculate_size, memoize,\
+        clear_instance_caches
+from geraldo.widgets import Widget, Label, SystemField, ObjectValue
 from geraldo.graphics import Graphic, RoundRect, Rect, Line, Circle, Arc,\
         Ellipse, Image
 from geraldo.barcodes import BarCode
-from geraldo.base import GeraldoObject, ManyElements
+from geraldo.base import GeraldoObject, ManyElements, Element
 from geraldo.cache import CACHE_BY_QUERYSET, CACHE_BY_RENDER, CACHE_DISABLED,\
-        make_hash_key, get_cache_backend
+        make_hash_key, get_cache_backend, STREAM_CHUNK_SIZE
 from geraldo.charts import BaseChart
-from geraldo.exceptions import AbortEvent
+from geraldo.exceptions import AbortEvent, StreamingError
+from geraldo.aggregations import RunningAggregate, make_aggregate_key
+
+# Used by render_bands to know the objects iterator is exhausted (because None
+# could be a valid object)
+NO_MORE_OBJECTS = object()
+
+# Used for missing styles, so they have always the same id
+NO_STYLE = {}
+
+# Objects of these types are not serialized with spooled pages, but kept in
+# memory and referenced (i.e. 'get_value' lambda functions)
+SPOOL_BY_REFERENCE_TYPES = (types.FunctionType, types.MethodType, types.BuiltinFunctionType,
+        types.ClassType, type)
+
+class PageSpool(object):
+    """Stores the elements of finished pages in a temporary file, to reduce memory
+    consuming on large reports. The elements are read back when requested.
+
+    Report, generator, bands, pages, functions and the objects from queryset are
+    not serialized, but kept in memory and referenced by the elements."""
+
+    _instances = ()
+    file = None
+    path = None
+
+    def __init__(self, directory=None):
+        fd, self.path = tempfile.mkstemp(prefix='geraldo-spool-', dir=directory)
+        self.file = os.fdopen(fd, 'w+b')
+        self._pid = os.getpid()
+        self._references = {}
+        self._references_ids = {}
+
+    def close(self):
+        """Closes and removes the spool file. There is no __del__ method to do this,
+        because the spool is in a reference cycle with the pages and the generator,
+        so generators call this at the end of 'execute' method (see close_spool)"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+            # Only the process that created the file removes it
+            if os.getpid() == self._pid:
+                os.remove(self.path)
+
+        self._references = {}
+        self._references_ids = {}
+
+    def reopen(self):
+        """Opens the spool file again to read it. Used by forked processes, that
+        can't share the file position with their parent (that must flush it
+        before forking)"""
+        self.file = file(self.path, 'rb')
+
+    def persistent_id(self, obj):
+        key = self._references_ids.get(id(obj), None)
+        if key is not None:
+            return key
+
+        if (isinstance(obj, GeraldoObject) and not isinstance(obj, Element)) or\
+           isinstance(obj, SPOOL_BY_REFERENCE_TYPES) or id(obj) in self._instances:
+            key = str(len(self._references))
+            self._references[key] = obj
+            self._references_ids[id(obj)] = key
+            return key
+
+        return None
+
+    def persistent_load(self, key):
+        return self._references[key]
+
+    def dump(self, elements):
+        """Stores the elements and returns their position on the spool file"""
+        self._instances = set([id(el.instance) for el in elements
+            if getattr(el, 'instance', None) is not None])
+
+        try:
+            self.file.seek(0, 2)
+            start = self.file.tell()
+
+            pickler = pickle.Pickler(self.file, pickle.HIGHEST_PROTOCOL)
+            pickler.persistent_id = self.persistent_id
+            pickler.dump(elements)
+
+            return start, self.file.tell() - start
+        finally:
+            self._instances = ()
+
+    def load(self, position):
+        """Returns the elements stored in the informed position"""
+        start, length = position
+        self.file.seek(start)
+
+        unpickler = pickle.Unpickler(self.file)
+        unpickler.persistent_load = self.persistent_load
+        return unpickler.load()
 
 class ReportPage(GeraldoObject):
     rect = None
     _elements = None
+    _spool = None
+    _spool_position = None
     width = None
     randomic_number = None
 
@@ -24,28 +127,75 @@ class ReportPage(GeraldoObject):
         self.randomic_number = str(random.randint(1, 999999)).zfill(6)
 
     def get_children(self):
-        return self._elements
+        return self.get_elements_list()
 
     def add_element(self, el):
-        """In future this method can be used to store pages on disk and reduce
-        memory consuming"""
+        """Adds an element to the page, restoring it from spool if necessary"""
+        if self._elements is None:
+            self.restore()
+
         self._elements.append(el)
 
-    @property
-    def elements(self):
-        """In future this method can be used to restore pages from disk and reduce
-        memory consuming"""
-        for el in self._elements:
-            yield el
+    def clear(self):
+        """Releases the page elements, after the page has been generated"""
+        self._elements = []
+        self._spool = self._spool_position = None
+
+    def spool(self, spool):
+        """Stores the page elements on the spool and releases them from memory.
+        Returns False if the elements couldn't be serialized (so they are kept)."""
+        # Spooled pages are never empty, so it's known without reading them back
+        if self._elements is None or not self._elements:
+            return True
+
+        try:
+            self._spool_position = spool.dump(self._elements)
+        except (pickle.PicklingError, TypeError, AttributeError, RuntimeError):
+            return False
+
+        self._spool = spool
+        self._elements = None
+        return True
+
+    def restore(self):
+        """Loads the page elements back from spool to memory"""
+        self._elements = self.get_elements_list()
+        self._spool = self._spool_position = None
+
+    def get_elements_list(self):
+        if self._elements is None:
+            return self._spool.load(self._spool_position)
+
+        return self._elements
+
+    def is_empty(self):
+        return self._elements is not None and not self._elements
+
+    # The page elements, read from the spool if the page has been spooled (but
+    # kept out of memory)
+    elements = property(lambda self: self.get_elements_list())
 
     @memoize
     def repr_for_cache_hash_key(self):
         return '/'.join([el.repr_for_cache_hash_key() for el in self.elements
             if hasattr(el, 'repr_for_cache_hash_key')])
 
+class TeeFile(object):
+    """A file object that writes to the output and also to a copy of it, used to
+    store the output in the cache while it is written"""
+
+    def __init__(self, output, copy):
+        self.output = output
+        self.copy = copy
+
+    def write(self, data):
+        self.output.write(data)
+        self.copy.write(data)
+
 class ReportGenerator(GeraldoObject):
     """A report generator is used to generate a report to a specific format."""
 
+    filename = None
     cache_enabled = None
     first_page_number = 1
     variables = None
@@ -61,19 +211,37 @@ class ReportGenerator(GeraldoObject):
     _current_queryset = None
     _generation_datetime = None
     _highest_height = 0
+    _cache_lock = None
 
     # Groupping
     _groups_values = None
     _groups_working_values = None
     _groups_changed = None
     _groups_stack = None
+    _groups_index = None
+
+    # Running aggregates (for groups footers and summary)
+    _aggregated_widgets = None
+    _running_aggregates = None
+    _running_groups_values = None
+    _current_aggregates = None
 
     # The rendered report has pages, each page is a ReportPage instance
     _rendered_pages = None
     _page_rect = None
 
+    # Spooling pages (when max_pages_in_memory is not None, the finished pages
+    # are stored in a temporary file, keeping just that count in memory)
+    max_pages_in_memory = None
+    spool_directory = None
+    _spool = None
+    _spooled_pages_index = 0
+
+    # Paragraph styles made for combinations of report, band and widget styles
+    _paragraph_styles = None
+
     def __init__(self, report, first_page_number=1, variables=None, return_pages=False,
-            pages=None, **kwargs):
+            pages=None, max_pages_in_memory=None, spool_directory=None, **kwargs):
         """This method should be overrided to receive others arguments"""
         self.report = report
 
@@ -89,6 +257,10 @@ class ReportGenerator(GeraldoObject):
         self.variables = variables or self.variables or {}
         self.return_pages = return_pages
 
+        if max_pages_in_memory is not None:
+            self.max_pages_in_memory = max_pages_in_memory
+        self.spool_directory = spool_directory or self.spool_directory
+
     def get_children(self):
         return self._rendered_pages
 
@@ -219,10 +391,11 @@ class ReportGenerator(GeraldoObject):
 
                 temp_height = self.calculate_size(element.top) + self.calculate_size(widget.height)
             elif isinstance(widget, Label):
-                para = self.make_paragraph(widget.text, self.make_paragraph_style(band, widget.style))
+                text = widget.text
+                para = self.make_paragraph(text, self.make_paragraph_style(band, widget.style))
 
                 if widget.truncate_overflow:
-                    self.keep_in_frame(
+                    keep = self.keep_in_frame(
                             widget,
                             self.calculate_size(widget.width),
                             self.calculate_size(widget.height),
@@ -232,11 +405,18 @@ class ReportGenerator(GeraldoObject):
 
                     widget.left = band_rect['left'] + self.calculate_size(widget.left)
                     widget.top = self.calculate_top(temp_top, self.calculate_size(widget.top), self.calculate_size(widget.height))
+
+                    # Keeps the frame laid out, to be drawn on generate
+                    if keep is not None:
+                        widget.set_paragraph(keep, text)
                 else:
                     self.wrap_paragraph_on(para, self.calculate_size(widget.width), self.calculate_size(widget.height))
                     widget.left = band_rect['left'] + self.calculate_size(widget.left)
                     widget.top = self.calculate_top(temp_top, self.calculate_size(widget.top), self.calculate_size(para.height))
 
+                    # Keeps the paragraph laid out, to be drawn on generate
+                    widget.set_paragraph(para, text)
+
                 temp_height = self.calculate_size(element.top) + self.calculate_size(para.height)
             else:
                 temp_height = self.calculate_size(element.top) + self.calculate_size(widget.height)
@@ -418,6 +598,35 @@ class ReportGenerator(GeraldoObject):
     def append_new_page(self):
         self._rendered_pages.append(ReportPage())
 
+        if self.max_pages_in_memory is not None:
+            self.spool_rendered_pages()
+
+    def close_spool(self):
+        """Closes and removes the spool of pages, if any. Generators call this at the
+        end of 'execute' method. Returned pages are read back to memory before."""
+        if self._spool is None:
+            return
+
+        if self.return_pages:
+            for page in self._rendered_pages:
+                if page._spool is self._spool:
+                    page.restore()
+
+        self._spool.close()
+        self._spool = None
+
+    def spool_rendered_pages(self):
+        """Stores the oldest pages on spool until there are just 'max_pages_in_memory'
+        pages in memory (the current page is never stored)"""
+        if self._spool is None:
+            self._spool = PageSpool(self.spool_directory)
+
+        max_pages = max(self.max_pages_in_memory, 1)
+
+        while len(self._rendered_pages) - self._spooled_pages_index > max_pages:
+            self._rendered_pages[self._spooled_pages_index].spool(self._spool)
+            self._spooled_pages_index += 1
+
     def start_new_page(self, with_header=True):
         """Starts a new blank page"""
         # Ends the current page
@@ -428,7 +637,7 @@ class ReportGenerator(GeraldoObject):
 
         self.report.do_on_new_page(
                 page=self._rendered_pages[-1],
-                page_number=len(self._rendered_pages) + self.first_page_number - 1,
+                page_number=self.get_page_count() + self.first_page_number - 1,
                 generator=self,
                 )
 
@@ -475,7 +684,9 @@ class ReportGenerator(GeraldoObject):
         self.force_blank_page_by_height(self.calculate_size(self.report.band_summary.height))
 
         # Call method that print the band area and its widgets
+        self._current_aggregates = self._running_aggregates and self._running_aggregates[0]
         self.render_band(self.report.band_summary)
+        self._current_aggregates = None
 
     def render_page_header(self):
         """Generate the report page header band if it exists"""
@@ -525,25 +736,41 @@ class ReportGenerator(GeraldoObject):
         self._is_first_page = False
         self.update_top_pos(set_position=0) # <---- update top position
  
+    def get_next_object(self, objects):
+        """Returns the next object from the objects iterator, or NO_MORE_OBJECTS
+        if it is exhausted"""
+        try:
+            return objects.next()
+        except StopIteration:
+            return NO_MORE_OBJECTS
+
     def render_bands(self):
-        """Loops into the objects list to create the report pages until the end"""
+        """Loops into the objects list to create the report pages until the end.
+
+        The objects are read from an iterator, with just one object of lookahead
+        (to know if the current one is the last), so this works on streaming mode
+        as well (see BaseReport.get_objects_iterator)"""
  
         # Preparing local auxiliar variables
         self._current_page_number = self.report.first_page_number
         self._current_object_index = 0
-        objects = self.report.get_objects_list()
+        objects = self.report.get_objects_iterator()
+        previous_object = None
+        self._groups_index = None
+        self.prepare_running_aggregates()
+        next_object = self.get_next_object(objects)
 
         # just an alias to make it shorter
         d_band = self.report.band_detail
 
         # Empty report
-        if self.report.print_if_empty and not objects:
+        if self.report.print_if_empty and next_object is NO_MORE_OBJECTS:
             self.start_new_page()
             self.render_begin()
             self.render_end_current_page()
 
         # Loop for pages
-        while self._current_object_index < len(objects):
+        while next_object is not NO_MORE_OBJECTS:
             # Starts a new page and generates the page header band
             self.start_new_page()
             first_object_on_page = True
@@ -554,12 +781,13 @@ class ReportGenerator(GeraldoObject):
 
             # Does generate objects if there is no details band
             if not d_band:
-                self._current_object_index = len(objects)
+                next_object = NO_MORE_OBJECTS
 
             # Loop for objects to go into grid on current page
-            while self._current_object_index < len(objects):
-                # Get current object from list
-                self._current_object = objects[self._current_object_index]
+            while next_object is not NO_MORE_OBJECTS:
+                # Get current object from iterator and reads the next one
+                self._current_object = next_object
+                next_object = self.get_next_object(objects)
 
                 # Renders group bands for changed values
                 self.calc_changed_groups(first_object_on_page)
@@ -568,9 +796,13 @@ class ReportGenerator(GeraldoObject):
                     # The current_object of the groups' footers is the previous 
                     # object, so we have access, in groups' footers, to the last
                     # object before the group breaking
-                    self._current_object = objects[self._current_object_index-1]
+                    current_object = self._current_object
+                    self._current_object = previous_object
                     self.render_groups_footers()
-                    self._current_object = objects[self._current_object_index]
+                    self._current_object = current_object
+
+                # Feeds running aggregates after footers of finished groups
+                self.update_running_aggregates()
 
                 self.render_groups_headers(first_object_on_page)
 
@@ -588,6 +820,7 @@ class ReportGenerator(GeraldoObject):
                     self.render_subreports()
 
                 # Next object
+                previous_object = self._current_object
                 self._current_object_index += 1
                 first_object_on_page = False
 
@@ -603,11 +836,11 @@ class ReportGenerator(GeraldoObject):
                             break
 
                     # ... or this band forces a new page and this is not the last object in objects list
-                    elif d_band.force_new_page and self._current_object_index < len(objects):
+                    elif d_band.force_new_page and next_object is not NO_MORE_OBJECTS:
                         break
 
             # Sets this is the latest page or not
-            self._is_latest_page = self._current_object_index >= len(objects)
+            self._is_latest_page = next_object is NO_MORE_OBJECTS
 
             # Renders the finish group footer bands
             if self._is_latest_page:
@@ -704,6 +937,15 @@ class ReportGenerator(GeraldoObject):
 
     # Stylizing
 
+    def clear_caches(self):
+        """Clears the memoized results stored by this generator while the report
+        was generated. Generators call this at the end of 'execute' method, so
+        long-running processes don't keep growing their memory with old reports.
+        Caches of memoized functions are bounded and shared by other generators
+        (maybe in other threads), so they are kept."""
+        clear_instance_caches(self)
+        self._paragraph_styles = None
+
     def set_fill_color(self, color):
         """Sets the current fill on canvas. Used for fonts and shape fills"""
         pass
@@ -730,7 +972,7 @@ class ReportGenerator(GeraldoObject):
         # changed also
         for group in self.report.groups:
             # Gets the current value to compare with the old one
-            current_value = get_attr_value(self._current_object, group.attribute_name)
+            current_value = get_attr_getter(group.attribute_name)(self._current_object)
 
             # Set changed as True if if wasn't and there is a change
             changed = changed or current_value != self._groups_values.get(group, None)
@@ -778,7 +1020,10 @@ class ReportGenerator(GeraldoObject):
                           self._groups_stack[-1] == group ):
                 if group.band_footer and group.band_footer.visible:
                     self.force_blank_page_by_height(self.calculate_size(group.band_footer.height))
+
+                    self._current_aggregates = self.get_group_running_aggregates(group)
                     self.render_band(group.band_footer)
+                    self._current_aggregates = None
 
                 if self._groups_stack:
                     self._groups_working_values.pop(self._groups_stack[-1])
@@ -787,12 +1032,19 @@ class ReportGenerator(GeraldoObject):
 
     def get_current_queryset(self):
         """Returns the current queryset. This solves a problem with subreports
-        footers and headers, and solves also flexibility and customization issues."""
+        footers and headers, and solves also flexibility and customization issues.
+
+        On streaming mode, the report objects are read just once, so StreamingError
+        is raised if they are needed here (i.e. by aggregations out of group footers
+        and summary, or failing to be calculated while objects are read)."""
 
         # Customized and SubReports
         if self._current_queryset is not None:
             return self._current_queryset
 
+        if self.report.streaming:
+            raise StreamingError('The objects of a report on streaming mode are read just once')
+
         # Groups
         elif self._groups_stack:
             return self.get_objects_in_group()
@@ -804,17 +1056,181 @@ class ReportGenerator(GeraldoObject):
         """Returns objects filtered in the current group or all if there is no
         group"""
 
-        filter_dict = dict([(group.attribute_name, value) for group, value in self._groups_working_values.items()])
+        # Working values of the first groups (that's the usual case) are found
+        # in the groups index, with no need to filter the whole queryset
+        objects = self.get_objects_in_group_from_index()
+        if objects is not None:
+            return objects
+
+        filter_list = [(get_attr_getter(group.attribute_name), value)
+                for group, value in self._groups_working_values.items()]
 
         def filter_object(obj):
-            for k,v in filter_dict.items():
-                if get_attr_value(obj, k) != v:
+            for getter,v in filter_list:
+                if getter(obj) != v:
                     return False
 
             return obj
 
         return filter(filter_object, self.report.queryset)
 
+    def get_groups_index(self):
+        """Returns a dictionary with the objects of each group, made in just one
+        pass on the queryset. The keys are tuples with values of the first groups
+        (i.e. (country,), (country, city), etc.) and the values are lists of objects
+        in the queryset order.
+
+        Returns None if the index can't be made, because of streaming mode (the
+        objects are not kept in memory) or unhashable group values."""
+
+        if self._groups_index is False:
+            return None
+        elif self._groups_index is not None:
+            return self._groups_index
+
+        self._groups_index = False
+        if self.report.streaming or not self.report.groups:
+            return None
+
+        index = {}
+        getters = [get_attr_getter(group.attribute_name) for group in self.report.groups]
+
+        try:
+            for obj in self.report.queryset:
+                values = tuple([getter(obj) for getter in getters])
+
+                for num in range(1, len(values)+1):
+                    index.setdefault(values[:num], []).append(obj)
+        except TypeError:
+            return None
+
+        self._groups_index = index
+        return index
+
+    def get_objects_in_group_from_index(self):
+        """Returns the objects in the current group from the groups index, or None
+        if the current working values can't be found there"""
+
+        groups = self.report.groups[:len(self._groups_working_values)]
+        if not groups or [group for group in groups if group not in self._groups_working_values]:
+            return None
+
+        index = self.get_groups_index()
+        if index is None:
+            return None
+
+        key = tuple([self._groups_working_values[group] for group in groups])
+
+        try:
+            return list(index.get(key, []))
+        except TypeError:
+            return None
+
+    # Running aggregates
+
+    def find_band_elements(self, band, typ):
+        """Returns the elements of the informed type in a band and its child bands"""
+        found = [el for el in band.elements if isinstance(el, typ)]
+
+        for child_band in band.child_bands or []:
+            found.extend(self.find_band_elements(child_band, typ))
+
+        return found
+
+    def prepare_running_aggregates(self):
+        """Finds the aggregations in groups footers and summary band. They are
+        calculated while objects are rendered, instead of scan the queryset for
+        each footer widget. There is one set of running aggregates for the report
+        (used by summary) plus one for each group (used by group footers)"""
+        self._aggregated_widgets = {}
+
+        if self.report.streaming:
+            self.check_streaming_aggregations()
+
+        bands = [group.band_footer for group in self.report.groups] + [self.report.band_summary]
+        for band in filter(bool, bands):
+            for widget in self.find_band_elements(band, ObjectValue):
+                for action, attribute_name in widget.get_aggregations(self.report.streaming):
+                    key = make_aggregate_key(widget, attribute_name)
+                    self._aggregated_widgets.setdefault(key, (widget, set()))[1].add(action)
+
+        self._running_aggregates = [self.make_running_aggregates()
+                for num in range(len(self.report.groups) + 1)]
+        self._running_groups_values = None
+
+    def check_streaming_aggregations(self):
+        """Raises StreamingError, before anything is rendered, if there are
+        aggregations out of group footers and summary band. On streaming mode the
+        objects are read just once, so they can't be calculated for other bands."""
+        bands = [(name, getattr(self.report, name)) for name in
+                ('band_begin', 'band_page_header', 'band_detail', 'band_page_footer')]
+        bands += [('band_header of group "%s"'%group.attribute_name, group.band_header)
+                for group in self.report.groups]
+
+        for name, band in bands:
+            if not band:
+                continue
+
+            for widget in self.find_band_elements(band, ObjectValue):
+                if widget.get_aggregations(True):
+                    raise StreamingError('Aggregations of a report on streaming mode can be '
+                            'shown just in group footers and summary, not in %s'%name)
+
+    def make_running_aggregates(self):
+        return dict([(key, RunningAggregate(actions, clean=widget._clean_empty_value))
+            for key, (widget, actions) in self._aggregated_widgets.items()])
+
+    def update_running_aggregates(self):
+        """Feeds the running aggregates with the current object. The aggregates of a
+        group are restarted when its value (or of a group above it) changes."""
+        if not self._aggregated_widgets:
+            return
+
+        # Restarts the aggregates from the first changed group
+        values = [self._groups_values.get(group, None) for group in self.report.groups]
+
+        if self._running_groups_values is not None:
+            for level, value in enumerate(values):
+                if value != self._running_groups_values[level]:
+                    for num in range(level + 1, len(self._running_aggregates)):
+                        self._running_aggregates[num] = self.make_running_aggregates()
+                    break
+
+        self._running_groups_values = values
+
+        for key, (widget, actions) in self._aggregated_widgets.items():
+            try:
+                value = widget.get_object_value(self._current_object, key[0])
+
+                for aggregates in self._running_aggregates:
+                    aggregates[key].feed(value)
+            except Exception:
+                # Failed aggregations are left to be calculated from the current
+                # queryset, when (and if) they are printed
+                self._aggregated_widgets.pop(key)
+
+                for aggregates in self._running_aggregates:
+                    aggregates.pop(key, None)
+
+    def get_group_running_aggregates(self, group):
+        if not self._running_aggregates:
+            return None
+
+        return self._running_aggregates[self.report.groups.index(group) + 1]
+
+    def get_running_aggregate(self, widget, attribute_name):
+        """Returns the running aggregate for a widget attribute in the band being
+        rendered, or None if there is no one (and then the widget has to calculate
+        from the current queryset)"""
+        if self._current_aggregates is None or self._current_queryset is not None:
+            return None
+
+        aggregate = self._current_aggregates.get(make_aggregate_key(widget, attribute_name), None)
+        if aggregate is None or not aggregate.length:
+            return None
+
+        return aggregate
+
     # SubReports
 
     def render_subreports(self):
@@ -873,33 +1289,108 @@ class ReportGenerator(GeraldoObject):
             self._current_queryset = None
 
     def make_paragraph_style(self, band, style=None):
-        """Merge report default_style + band default_style + widget style"""
+        """Merge report default_style + band default_style + widget style. The
+        style is made once for each combination of them, and reused."""
+        if self._paragraph_styles is None:
+            self._paragraph_styles = {}
+
+        styles = (self.report.default_style or NO_STYLE, band.default_style or NO_STYLE,
+                style or NO_STYLE)
+
+        # The style dictionaries can be changed (i.e. by events), so the stored
+        # copies are compared to them
+        key = (id(styles[0]), id(styles[1]), id(styles[2]))
+        stored = self._paragraph_styles.get(key, None)
+
+        if stored is None or stored[0] != styles:
+            d_style = {}
+            for item in styles:
+                d_style.update(item)
+
+            stored = self._paragraph_styles[key] = (
+                    tuple([item.copy() for item in styles]),
+                    self.new_paragraph_style(d_style, len(self._paragraph_styles)),
+                    )
+
+        return stored[1]
+
+    def new_paragraph_style(self, d_style, number):
+        """Returns a new paragraph style for the merged style dictionary"""
         raise Exception('Not implemented')
 
     def keep_in_frame(self, widget, width, height, paragraphs, mode):
         raise Exception('Not implemented')
 
+    def has_cache_output(self):
+        """Returns True if the output is a file path or stream, that can be
+        fetched from and stored in the cache"""
+        return isinstance(self.filename, basestring) or\
+               (hasattr(self.filename, 'write') and callable(self.filename.write))
+
     def fetch_from_cache(self):
-        if self.report.cache_status == CACHE_BY_QUERYSET:
-            hash_key = self.get_hash_key(self.report.queryset)
-        elif self.report.cache_status == CACHE_BY_RENDER:
-            hash_key = self.get_hash_key(self._rendered_pages)
+        """Copies the cached content to the output file in chunks, without loading
+        it whole in memory. Returns True if it was found in the cache."""
+        if not self.has_cache_output():
+            return False
+
+        hash_key = self.get_cache_hash_key()
+        if hash_key is None:
+            return False
+
+        # Write to file stream or to file path
+        if isinstance(self.filename, basestring):
+            output = None
+        else:
+            output = self.filename
 
         cache = self.get_cache_backend()
-        buffer = cache.get(hash_key)
-
-        if buffer:
-            # Write to file stream
-            if hasattr(self.filename, 'write') and callable(self.filename.write):
-                self.filename.write(buffer)
-                return True
-                
-            # Write to file path
-            elif isinstance(self.filename, basestring):
-                fp = file(self.filename, 'w')
-                fp.write(buffer)
-                fp.close()
-                return True
+        stream = cache.get_stream(hash_key)
+        if stream is None:
+            return False
+
+        try:
+            if output is None:
+                output = file(self.filename, 'wb')
+                try:
+                    shutil.copyfileobj(stream, output, STREAM_CHUNK_SIZE)
+                finally:
+                    output.close()
+            else:
+                shutil.copyfileobj(stream, output, STREAM_CHUNK_SIZE)
+        finally:
+            stream.close()
+
+        return True
+
+    def fetch_from_cache_or_lock(self):
+        """Fetches the report from cache. If it is not there, acquires the lock for
+        its hash key, so concurrent generators of the same report wait for this one
+        to generate and store it, and then fetch it from the cache instead of
+        generating it again. The lock is released by 'release_cache_lock'."""
+        if self.fetch_from_cache():
+            return True
+
+        cache = self.get_cache_backend()
+        if not self.has_cache_output() or not hasattr(cache, 'lock') or\
+           self.get_cache_hash_key() is None:
+            return False
+
+        self._cache_lock = cache.lock(self.get_cache_hash_key())
+        self._cache_lock.acquire()
+
+        # Other generator could store it while this one was waiting
+        if self.fetch_from_cache():
+            self.release_cache_lock()
+            return True
+
+        return False
+
+    def release_cache_lock(self):
+        """Releases the lock acquired by 'fetch_from_cache_or_lock', if any.
+        Generators call this at the end of 'execute' method."""
+        if self._cache_lock is not None:
+            self._cache_lock.release()
+            self._cache_lock = None
 
     def cached_before_render(self):
         """Check and loads the generated report from caching system before call method
@@ -908,7 +1399,7 @@ class ReportGenerator(GeraldoObject):
         if not self.cache_enabled or self.report.cache_status != CACHE_BY_QUERYSET:
             return False
 
-        return self.fetch_from_cache()
+        return self.fetch_from_cache_or_lock()
 
     def cached_before_generate(self):
         """Check and loads the generated report from caching system before call method
@@ -917,30 +1408,55 @@ class ReportGenerator(GeraldoObject):
         if not self.cache_enabled or self.report.cache_status != CACHE_BY_RENDER:
             return False
 
-        return self.fetch_from_cache()
+        return self.fetch_from_cache_or_lock()
 
     def store_in_cache(self, content):
-        """Sends the canvas content to write in the cache backend"""
+        """Sends the canvas content to write in the cache backend. The content can
+        be a string or a file object, copied in chunks to the cache."""
 
-        if not self.cache_enabled or self.report.cache_status == CACHE_DISABLED:
+        if not self.cache_enabled or self.report.cache_status not in (CACHE_BY_QUERYSET, CACHE_BY_RENDER):
             return
 
-        if self.report.cache_status == CACHE_BY_QUERYSET:
-            hash_key = self.get_hash_key(self.report.queryset)
-        elif self.report.cache_status == CACHE_BY_RENDER:
-            hash_key = self.get_hash_key(self._rendered_pages)
+        hash_key = self.get_cache_hash_key()
+        if hash_key is None:
+            return
 
         cache = self.get_cache_backend()
 
+        if hasattr(content, 'read'):
+            return cache.set_stream(hash_key, content)
+
         return cache.set(hash_key, content)
 
-    def get_hash_key(self, objects):
+    @memoize
+    def get_cache_hash_key(self):
+        """Returns the hash key for the current cache status. It is calculated just
+        once, to be used to fetch from and to store in the cache.
+
+        When caching by queryset, if the report has a method 'get_cache_fingerprint'
+        returning something different of None (i.e. the count and the latest
+        modification date of the objects), the hash key is made from it, instead of
+        reading all the objects."""
+        if self.report.cache_status == CACHE_BY_QUERYSET:
+            fingerprint = None
+            if hasattr(self.report, 'get_cache_fingerprint'):
+                fingerprint = self.report.get_cache_fingerprint()
+
+            # On streaming mode, the objects can't be read before rendering
+            if fingerprint is None and self.report.streaming:
+                return None
+
+            return self.get_hash_key(self.report.queryset, fingerprint=fingerprint)
+        elif self.report.cache_status == CACHE_BY_RENDER:
+            return self.get_hash_key(self._rendered_pages)
+
+    def get_hash_key(self, objects, fingerprint=None):
         """Calculates the hash_key, appending/prepending something if necessary"""
-        return make_hash_key(self.report, objects)
+        return make_hash_key(self.report, objects, fingerprint=fingerprint)
 
     def get_cache_backend(self):
-        return get_cache_backend(
-                self.report.cache_backend,
-                cache_file_root=self.report.cache_file_root,
-                )
+        kwargs = {'cache_file_root': self.report.cache_file_root}
+        kwargs.update(self.report.cache_backend_kwargs)
+
+        return get_cache_backend(self.report.cache_backend, **kwargs)
 
@@ -1,10 +1,11 @@
-import datetime, csv
-from base import ReportGenerator
+import datetime, csv, tempfile
+from base import ReportGenerator, TeeFile
 
 from geraldo.utils import get_attr_value, calculate_size
 from geraldo.widgets import Widget, Label, SystemField, ObjectValue
 from geraldo.graphics import Graphic, RoundRect, Rect, Line, Circle, Arc,\
         Ellipse, Image
+from geraldo.cache import CACHE_BY_QUERYSET
 from geraldo.exceptions import AbortEvent
 
 class CSVGenerator(ReportGenerator):
@@ -24,6 +25,9 @@ class CSVGenerator(ReportGenerator):
 
     mimetype = 'text/csv'
 
+    _output_file = None
+    _cache_copy = None
+
     def __init__(self, report, cache_enabled=None, writer=None, first_row_with_column_names=None, **kwargs):
         super(CSVGenerator, self).__init__(report, **kwargs)
 
@@ -51,7 +55,14 @@ class CSVGenerator(ReportGenerator):
         filename = filename or self.filename
 
         if isinstance(filename, basestring):
-            filename = file(filename, 'w')
+            filename = self._output_file = file(filename, 'w')
+
+        # The output is copied to a temporary file while it is written, to be
+        # stored in the cache at the end
+        if self.cache_enabled and self.report.cache_status == CACHE_BY_QUERYSET and\
+           self.has_cache_output():
+            self._cache_copy = tempfile.TemporaryFile()
+            filename = TeeFile(filename, self._cache_copy)
 
         # Default writer uses comma as separator and quotes only when necessary
         self.writer = self.writer_function(filename, quoting=csv.QUOTE_MINIMAL)
@@ -59,18 +70,41 @@ class CSVGenerator(ReportGenerator):
     def execute(self):
         super(CSVGenerator, self).execute()
 
-        # Calls the before_print event
-        self.report.do_before_print(generator=self)
+        try:
+            # Check the cache (a customized writer has its own output, so the
+            # cache is not used with it)
+            if not self.writer and self.cached_before_render():
+                return
+
+            # Calls the before_print event
+            self.report.do_before_print(generator=self)
+
+            # Write the CSV output
+            self.generate_csv()
+
+            # Closes the output file opened by 'start_writer'
+            if self._output_file:
+                self._output_file.close()
+                self._output_file = None
+
+            # Calls the after_print event
+            self.report.do_after_print(generator=self)
 
-        # Write the CSV output
-        self.generate_csv()
+            # Store in the cache
+            if self._cache_copy:
+                self._cache_copy.seek(0)
+                self.store_in_cache(self._cache_copy)
+        finally:
+            if self._cache_copy:
+                self._cache_copy.close()
+                self._cache_copy = None
 
-        # Calls the after_print event
-        self.report.do_after_print(generator=self)
+            self.release_cache_lock()
+            self.clear_caches()
 
-    def get_hash_key(self, objects):
+    def get_hash_key(self, objects, fingerprint=None):
         """Appends pdf extension to the hash_key"""
-        return super(CSVGenerator, self).get_hash_key(objects) + '.csv'
+        return super(CSVGenerator, self).get_hash_key(objects, fingerprint) + '.csv'
 
     # METHODS THAT ARE TOTALLY SPECIFIC TO THIS GENERATOR AND MUST
     # OVERRIDE THE SUPERCLASS EQUIVALENT ONES
@@ -79,7 +113,7 @@ class CSVGenerator(ReportGenerator):
         """Generates the CSV output"""
 
         self._current_object_index = 0
-        objects = self.report.get_objects_list()
+        objects = self.report.get_objects_iterator()
 
         self.start_writer()
 
@@ -92,9 +126,9 @@ class CSVGenerator(ReportGenerator):
             cells = [(col.name or col.expression or col.attribute_name) for col in columns]
             self.writer.writerow(cells)
 
-        while self._current_object_index < len(objects):
-            # Get current object from list
-            self._current_object = objects[self._current_object_index]
+        for obj in objects:
+            # Get current object from iterator
+            self._current_object = obj
 
             cells = []
 
@@ -1,4 +1,4 @@
-import datetime, os
+import datetime, os, re, heapq, itertools, shutil, warnings
 from base import ReportGenerator
 
 from reportlab.pdfgen.canvas import Canvas
@@ -8,6 +8,13 @@ from reportlab.lib.units import cm
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.lib.fonts import addMapping
+from reportlab.lib.enums import TA_LEFT, TA_CENTER, TA_RIGHT
+from reportlab import rl_config
+
+try:
+    set
+except NameError:
+    from sets import Set as set     # Python 2.3 fallback
 
 try:
     # Try to import pyPdf, a library to combine lots of PDF files
@@ -18,17 +25,391 @@ try:
 except ImportError:
     pyPdf = None
 
+try:
+    # Used to generate pages in parallel (Python 2.6 or higher, or the package
+    # python-multiprocessing)
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
 DEFAULT_TEMP_DIR = '/tmp/'
 
-from geraldo.utils import get_attr_value, calculate_size
-from geraldo.widgets import Widget, Label, SystemField
+from geraldo.utils import get_attr_value, calculate_size, run_in_new_processes,\
+        in_worker_process
+from geraldo.widgets import Widget, Label, SystemField, ObjectValue
 from geraldo.graphics import Graphic, RoundRect, Rect, Line, Circle, Arc,\
         Ellipse, Image
 from geraldo.barcodes import BarCode
-from geraldo.cache import make_hash_key, get_cache_backend, CACHE_DISABLED
+from geraldo.cache import make_hash_key, get_cache_backend, CACHE_DISABLED,\
+        CACHE_BY_RENDER, CACHE_BY_PAGE, STREAM_CHUNK_SIZE
 from geraldo.charts import BaseChart
 from geraldo.exceptions import AbortEvent
 
+# Texts with markup, line breaks, non-breaking or repeated spaces are drawn by
+# Paragraph, because it changes them
+EXP_NOT_PLAIN_TEXT = re.compile(r'[<>&\t\n\r\x0b\x0c]|  |^ | $')
+NBSP_CHARS = (u'\xa0', '\xc2\xa0')
+
+def is_plain_style(style):
+    """Returns True if the paragraph style has nothing but font, color, alignment
+    and indents, so a single line text can be drawn without Paragraph. The result
+    is stored in the style (they are reused by generators)."""
+    plain = getattr(style, '_is_plain', None)
+
+    if plain is None:
+        plain = style._is_plain = bool(
+                style.alignment in (TA_LEFT, TA_CENTER, TA_RIGHT) and
+                not style.firstLineIndent and
+                not style.backColor and
+                not (getattr(style, 'borderWidth', 0) and getattr(style, 'borderColor', None)) and
+                not getattr(style, 'wordWrap', None) and
+                getattr(style, 'autoLeading', '') in ('', 'off', None) and
+                not getattr(style, 'endDots', None) and
+                not getattr(style, 'textTransform', None)
+                )
+
+    return plain
+
+def is_plain_text(text, style):
+    """Returns True if the text can be drawn as a plain string (in a single line
+    that fits the width, checked by PlainParagraph)"""
+    if not text or not isinstance(text, basestring) or EXP_NOT_PLAIN_TEXT.search(text):
+        return False
+
+    for char in NBSP_CHARS:
+        if isinstance(text, type(char)) and char in text:
+            return False
+
+    return is_plain_style(style)
+
+class PlainParagraph(object):
+    """Works like a Paragraph for a text without markup, drawing it as a plain
+    string in the same position. If the text doesn't fit the width in a single
+    line, a Paragraph is made to wrap and draw it instead."""
+
+    paragraph = None
+    width = height = 0
+
+    def __init__(self, text, style):
+        self.text = text
+        self.style = style
+
+    def get_paragraph(self):
+        """Returns a Paragraph with the same text and style"""
+        if self.paragraph is None:
+            self.paragraph = Paragraph(self.text, self.style)
+
+        return self.paragraph
+
+    def wrap(self, availWidth, availHeight):
+        style = self.style
+        self.text_width = pdfmetrics.stringWidth(self.text, style.fontName, style.fontSize)
+        self.extra_space = availWidth - style.leftIndent - style.rightIndent - self.text_width
+
+        # Doesn't fit in a single line
+        if availWidth < 1e-8 or self.extra_space < -1e-8:
+            self.width, self.height = self.get_paragraph().wrap(availWidth, availHeight)
+            return self.width, self.height
+
+        self.paragraph = None
+        self.width = availWidth
+        self.height = style.leading
+        return self.width, self.height
+
+    def wrapOn(self, canv, availWidth, availHeight):
+        return self.wrap(availWidth, availHeight)
+
+    def is_plain(self):
+        """Returns True if the text is drawn as a plain string"""
+        return self.paragraph is None
+
+    def get_text_origin(self, x, y):
+        """Returns the position of the text, like Paragraph does for the first line"""
+        style = self.style
+
+        if style.alignment == TA_CENTER:
+            x += style.leftIndent + 0.5 * self.extra_space
+        elif style.alignment == TA_RIGHT:
+            x += style.leftIndent + self.extra_space
+        else:
+            x += style.leftIndent
+
+        if getattr(rl_config, 'paraFontSizeHeightOffset', 1):
+            y += self.height - style.fontSize
+        else:
+            y += self.height - pdfmetrics.getAscentDescent(style.fontName, style.fontSize)[0]
+
+        return x, y
+
+    def drawOn(self, canvas, x, y, _sW=0):
+        if not self.is_plain():
+            return self.paragraph.drawOn(canvas, x, y, _sW)
+
+        batch = TextBatch(canvas)
+        batch.add(self, x, y)
+        batch.flush()
+
+class TextBatch(object):
+    """Draws the texts of many plain paragraphs in a single PDF text object,
+    setting font and color just when they change."""
+
+    text_object = None
+
+    def __init__(self, canvas):
+        self.canvas = canvas
+
+    def add(self, para, x, y):
+        style = self.style = para.style
+
+        if self.text_object is None:
+            self.text_object = self.canvas.beginText()
+            self.font = self.color = None
+
+        font = (style.fontName, style.fontSize, style.leading)
+        if font != self.font:
+            self.text_object.setFont(*font)
+            self.font = font
+
+        if style.textColor != self.color:
+            self.text_object.setFillColor(style.textColor)
+            self.color = style.textColor
+
+        self.text_object.setTextOrigin(*para.get_text_origin(x, y))
+        self.text_object.textOut(para.text)
+
+    def flush(self):
+        """Draws the texts added until now on canvas"""
+        if self.text_object is not None:
+            self.canvas.saveState()
+            self.canvas.drawText(self.text_object)
+            self.canvas.restoreState()
+            self.text_object = None
+
+class CanvasState(object):
+    """Keeps the values of fill color, stroke color and line width last set on a
+    canvas, so the same values are not set again. It must be reset when they are
+    not known (i.e. on a new page or after events, that can draw on canvas)."""
+
+    canvas = None
+
+    def __init__(self, canvas=None):
+        self.reset(canvas)
+
+    def reset(self, canvas=None):
+        self.canvas = canvas
+        self.values = {}
+
+    def changes(self, canvas, name, value):
+        """Returns True if the value is different from the current one on canvas,
+        and keeps it as the current one"""
+        if canvas is not self.canvas:
+            self.reset(canvas)
+        elif name in self.values and self.values[name] == value:
+            return False
+
+        self.values[name] = value
+        return True
+
+def get_element_box(element):
+    """Returns the box (x1, y1, x2, y2) an element can draw on, with some margin.
+    Used to know if elements overlap."""
+    try:
+        if isinstance(element, Circle):
+            x1 = element.left_center - element.radius
+            y1 = element.top_center - element.radius
+            x2 = element.left_center + element.radius
+            y2 = element.top_center + element.radius
+        elif isinstance(element, (Line, Arc, Ellipse)):
+            x1, x2 = element.left, element.right
+            y1, y2 = element.top, element.bottom
+        elif isinstance(element, Widget):
+            # The widget top can be the top or the bottom of its text
+            x1, x2 = element.left, element.left + element.width
+            y1, y2 = element.top - element.height, element.top + element.height
+        else:
+            x1, x2 = element.left, element.left + element.width
+            y1, y2 = element.top, element.top + element.height
+
+        margin = getattr(element, 'stroke_width', 0) or 0
+        return (min(x1, x2) - margin, min(y1, y2) - margin,
+                max(x1, x2) + margin, max(y1, y2) + margin)
+    except (TypeError, AttributeError):
+        # Unknown sizes, so it overlaps everything
+        return None
+
+def boxes_overlap(box1, box2):
+    if box1 is None or box2 is None:
+        return True
+
+    return box1[0] <= box2[2] and box2[0] <= box1[2] and\
+           box1[1] <= box2[3] and box2[1] <= box1[3]
+
+def get_drawing_state(element):
+    """Returns the values an element sets on canvas to be drawn"""
+    if isinstance(element, Widget):
+        state = (Widget, element.font_color)
+    else:
+        state = (Graphic, element.fill_color, element.stroke_color, element.stroke_width)
+
+    # The state is used as dictionary key
+    try:
+        hash(state)
+    except TypeError:
+        state = repr(state)
+
+    return state
+
+# Height of the strips a page is split into, to find the overlapping elements
+OVERLAP_STRIP_HEIGHT = 20
+
+def find_overlaps(elements, boxes):
+    """Returns a list of pairs of indexes of overlapping elements, if one of them
+    is a graphic. Elements are grouped by horizontal strips of the page, so each
+    graphic is compared just to the elements near to it."""
+    strips = {}
+    unknown = []
+    for num in range(len(elements)):
+        if boxes[num] is None:
+            unknown.append(num)
+            continue
+
+        for strip in range(int(boxes[num][1] // OVERLAP_STRIP_HEIGHT),
+                int(boxes[num][3] // OVERLAP_STRIP_HEIGHT) + 1):
+            strips.setdefault(strip, []).append(num)
+
+    pairs = set()
+    for num in range(len(elements)):
+        if not isinstance(elements[num], Graphic):
+            continue
+
+        if boxes[num] is None:
+            others = range(len(elements))
+        else:
+            others = list(unknown)
+            for strip in range(int(boxes[num][1] // OVERLAP_STRIP_HEIGHT),
+                    int(boxes[num][3] // OVERLAP_STRIP_HEIGHT) + 1):
+                others.extend(strips.get(strip, []))
+
+        for other in others:
+            if other != num and boxes_overlap(boxes[num], boxes[other]):
+                pairs.add((min(num, other), max(num, other)))
+
+    return pairs
+
+def sort_by_drawing_state(elements):
+    """Returns the elements sorted to draw together the ones with the same drawing
+    state (colors and line width), so fewer state changes are made on canvas.
+
+    A graphic is never moved over or under other element it overlaps, so the
+    result looks the same."""
+    count = len(elements)
+    boxes = [get_element_box(el) for el in elements]
+    states = [get_drawing_state(el) for el in elements]
+
+    # Overlapping elements must keep their order
+    waiting = [0] * count
+    followers = [[] for num in range(count)]
+    for first, last in find_overlaps(elements, boxes):
+        followers[first].append(last)
+        waiting[last] += 1
+
+    # Available elements, in their order and by state
+    available = []
+    by_state = {}
+    drawn = [False] * count
+
+    def make_available(num):
+        heapq.heappush(available, num)
+        heapq.heappush(by_state.setdefault(states[num], []), num)
+
+    def pop_available(heap):
+        while heap:
+            num = heapq.heappop(heap)
+            if not drawn[num]:
+                return num
+
+    for num in range(count):
+        if not waiting[num]:
+            make_available(num)
+
+    # Draws the next element with the same state of the previous one or, if there
+    # is no one, the first available
+    ret = []
+    state = None
+    while len(ret) < count:
+        num = pop_available(by_state.get(state, []))
+        if num is None:
+            num = pop_available(available)
+
+        drawn[num] = True
+        ret.append(elements[num])
+        state = states[num]
+
+        for follower in followers[num]:
+            waiting[follower] -= 1
+            if not waiting[follower]:
+                make_available(follower)
+
+    return ret
+
+# Font files registered in this process, by font name
+_registered_fonts = {}
+
+def is_static_element(element):
+    """Returns True if the element is drawn the same way on every page: labels and
+    simple graphics, with no events nor values depending on objects or pages"""
+    if element.before_print or element.after_print:
+        return False
+
+    if isinstance(element, Label):
+        return not isinstance(element, (ObjectValue, SystemField)) and not element.get_value
+
+    if isinstance(element, Image):
+        return bool(element.filename) and not element.get_image
+
+    return isinstance(element, (Rect, Line, Circle, Arc, Ellipse))
+
+# Numbers the generators, to prefix the names of their PDF forms, so the forms of
+# many generators drawing on the same canvas don't clash
+_forms_prefixes_counter = itertools.count()
+
+def get_static_key(element):
+    """Returns a value identifying how a static element is drawn"""
+    return (element.__class__, element.repr_for_cache_hash_key(),
+            getattr(element, 'font_color', None), getattr(element, 'truncate_overflow', None))
+
+def register_font(font_name, font_file):
+    """Registers a TTF font, unless it was already registered with the same file
+    in this process (i.e. by a previous report or when the worker started)."""
+    if _registered_fonts.get(font_name, None) == font_file:
+        return
+
+    pdfmetrics.registerFont(TTFont(font_name, font_file))
+    _registered_fonts[font_name] = font_file
+
+def register_additional_fonts(additional_fonts):
+    """Registers the fonts of a dictionary in the format of report attribute
+    'additional_fonts'."""
+    for font_family_name, fonts_or_file in additional_fonts.iteritems():
+        # Supports font family with many styles (i.e: normal, italic, bold, bold-italic, etc.)
+        if isinstance(fonts_or_file, (list, tuple, dict)):
+            for font_item in fonts_or_file:
+                # List of tuples with format like ('font-name', 'font-file', True/False bold, True/False italic)
+                if isinstance(font_item, (list, tuple)):
+                    font_name, font_file, is_bold, is_italic = font_item
+                    register_font(font_name, font_file)
+                    addMapping(font_family_name, is_bold, is_italic, font_name)
+
+                # List of dicts with format like {'file': '', 'name': '', 'bold': False, 'italic': False}
+                elif isinstance(font_item, dict):
+                    register_font(font_item['name'], font_item['file'])
+                    addMapping(font_family_name, font_item.get('bold', False),
+                            font_item.get('italic', False), font_item['name'])
+
+        # Old style: font name and file path
+        else:
+            register_font(font_family_name, fonts_or_file)
+
 class PDFGenerator(ReportGenerator):
     """This is a generator to output a PDF using ReportLab library with
     preference by its Platypus API"""
@@ -43,15 +424,47 @@ class PDFGenerator(ReportGenerator):
     temp_files_counter = 0
     temp_files_max_pages = 10
     temp_directory = DEFAULT_TEMP_DIR
+    parallel_processes = None
+    _parallel_pages = None
+
+    # Streaming pages: each page is drawn on canvas when it is finished and then
+    # released, instead of keeping all pages in memory to generate them at the end
+    stream_pages = False
+    _streamed_pages_count = 0
+    _deferred_widgets = None
+    _text_batch = None
+    _canvas_state = None
+    _static_bands = None
+    _static_forms = None
+    _forms_prefix = None
+
+    # Set this to True to sort the elements of each page by their colors and line
+    # widths, to make less state changes on canvas (see 'sort_by_drawing_state')
+    sort_elements = False
+
+    # Static elements of page header and footer (see 'is_static_element') are
+    # drawn once in a PDF form, referenced by all pages. Set this to False to draw
+    # them on each page
+    static_forms = True
 
     mimetype = 'application/pdf'
 
     def __init__(self, report, filename=None, canvas=None, return_canvas=False,
             multiple_canvas=None, temp_directory=None, cache_enabled=None,
-            **kwargs):
+            stream_pages=None, parallel_processes=None, sort_elements=None,
+            static_forms=None, **kwargs):
         super(PDFGenerator, self).__init__(report, **kwargs)
 
         self.filename = filename
+        self._canvas_state = CanvasState()
+        self._static_forms = {}
+        self._forms_prefix = 'Geraldo%d'%_forms_prefixes_counter.next()
+
+        if sort_elements is not None:
+            self.sort_elements = sort_elements
+
+        if static_forms is not None:
+            self.static_forms = static_forms
         self.canvas = canvas
         self.return_canvas = return_canvas
         self.temp_directory = temp_directory or self.temp_directory
@@ -66,10 +479,31 @@ class PDFGenerator(ReportGenerator):
         if multiple_canvas is not None:
             self.multiple_canvas = multiple_canvas
 
+        # Parallel generation draws chunks of pages in multiple canvas, in forked
+        # processes, and combines them at the end. Worker processes (daemonic
+        # ones included) can't start processes, so they generate in sequence
+        if parallel_processes is not None:
+            self.parallel_processes = parallel_processes
+
+        if not multiprocessing or not pyPdf or not hasattr(os, 'fork') or\
+           (self.parallel_processes or 0) < 2 or in_worker_process():
+            self.parallel_processes = None
+        else:
+            self.multiple_canvas = True
+
+        # Caching by page combines cached and generated pages, like multiple canvas
+        if self.cache_enabled and self.report.cache_status == CACHE_BY_PAGE:
+            if pyPdf:
+                self.multiple_canvas = True
+                self.parallel_processes = None
+            else:
+                warnings.warn('Caching by page needs pyPdf library, so pages are not cached')
+
         # Sets multiple_canvas as False if a canvas has been informed as argument
         # nor if return_canvas attribute is setted as True
         if canvas or self.return_canvas or self.return_pages:
             self.multiple_canvas = False
+            self.parallel_processes = None
             
         # Initializes multiple canvas controller variables
         elif self.multiple_canvas:
@@ -78,82 +512,145 @@ class PDFGenerator(ReportGenerator):
             # Just a unique name (current time + id of this object + formatting string for counter + PDF extension)
             self.temp_file_name = datetime.datetime.now().strftime('%Y%m%d%H%M%s') + str(id(self)) + '_%s.pdf'
 
+        # Sets stream_pages with default value if None
+        if stream_pages is not None:
+            self.stream_pages = stream_pages
+
+        # Streaming pages doesn't work when all the rendered pages are needed
+        # together: to return them, to split them into multiple canvas or to make
+        # the cache hash key from them
+        if self.return_pages or self.multiple_canvas or\
+           (self.cache_enabled and self.report.cache_status == CACHE_BY_RENDER):
+            self.stream_pages = False
+
+        if self.stream_pages:
+            self._deferred_widgets = []
+
     def execute(self):
         """Generates a PDF file using ReportLab pdfgen package."""
         super(PDFGenerator, self).execute()
 
-        # Check the cache
-        if self.cached_before_render():
-            return
+        try:
+            # Check the cache
+            if self.cached_before_render():
+                return
 
-        # Initializes the temporary PDF canvas (just to be used as reference)
-        if not self.canvas:
-            self.start_canvas()
+            # Initializes the temporary PDF canvas (just to be used as reference)
+            if not self.canvas:
+                self.start_canvas()
 
-        # Prepare additional fonts
-        self.prepare_additional_fonts()
+            # Prepare additional fonts
+            self.prepare_additional_fonts()
 
-        # Calls the before_print event
-        self.report.do_before_print(generator=self)
+            # Calls the before_print event
+            self.report.do_before_print(generator=self)
 
-        # Render pages
-        self.render_bands()
+            # Render and generate pages together
+            if self.stream_pages:
+                return self.execute_streaming_pages()
 
-        # Returns rendered pages
-        if self.return_pages:
-            return self._rendered_pages
+            # Render pages
+            self.render_bands()
 
-        # Check the cache
-        if self.cached_before_generate():
-            return
+            # Returns rendered pages
+            if self.return_pages:
+                return self._rendered_pages
+
+            # Check the cache
+            if self.cached_before_generate():
+                return
  
-        # Calls the "after render" event
+            # Calls the "after render" event
+            self.report.do_before_generate(generator=self)
+
+            # Initializes the definitive PDF canvas
+            self.start_pdf()
+
+            # Generate the report pages (here it happens)
+            self.generate_pages()
+
+            # Calls the after_print event
+            self.report.do_after_print(generator=self)
+
+            # Multiple canvas files combination
+            if self.multiple_canvas:
+                self.combine_multiple_canvas()
+
+            else:
+                # Returns the canvas
+                if self.return_canvas:
+                    return self.canvas
+
+                # Saves the canvas - only if it didn't return it
+                self.close_current_canvas()
+
+            # Store in the cache
+            self.store_in_cache()
+        finally:
+            self.release_cache_lock()
+            self.close_spool()
+            self.clear_caches()
+
+    def execute_streaming_pages(self):
+        """Renders the pages, generating each one on the canvas when it is finished
+        (see 'append_new_page'). Widgets depending on the page count are drawn as
+        PDF forms, defined just at the end, when the page count is known."""
+
+        # Calls the "after render" event (there is no moment between rendering
+        # and generating on this mode)
         self.report.do_before_generate(generator=self)
 
-        # Initializes the definitive PDF canvas
+        # Initializes the PDF document (the canvas is the same used to render)
         self.start_pdf()
+        self._generation_datetime = datetime.datetime.now()
+
+        # Render pages and generate the latest one
+        self.render_bands()
+        self.generate_rendered_pages()
 
-        # Generate the report pages (here it happens)
-        self.generate_pages()
+        # Draws widgets deferred to know the page count
+        self.generate_deferred_widgets()
 
         # Calls the after_print event
         self.report.do_after_print(generator=self)
 
-        # Multiple canvas files combination
-        if self.multiple_canvas:
-            self.combine_multiple_canvas()
-
-        else:
-            # Returns the canvas
-            if self.return_canvas:
-                return self.canvas
+        # Returns the canvas
+        if self.return_canvas:
+            return self.canvas
 
-            # Saves the canvas - only if it didn't return it
-            self.close_current_canvas()
+        # Saves the canvas - only if it didn't return it
+        self.close_current_canvas()
 
         # Store in the cache
         self.store_in_cache()
 
-    def get_hash_key(self, objects):
+    def get_hash_key(self, objects, fingerprint=None):
         """Appends pdf extension to the hash_key"""
-        return super(PDFGenerator, self).get_hash_key(objects) + '.pdf'
+        return super(PDFGenerator, self).get_hash_key(objects, fingerprint) + '.pdf'
 
     def store_in_cache(self):
-        if not self.cache_enabled or self.report.cache_status == CACHE_DISABLED:
+        if not self.cache_enabled or self.report.cache_status in (CACHE_DISABLED, CACHE_BY_PAGE):
             return
 
-        # Gest canvas content to store in the cache
+        # Sends the generated file to be copied in chunks to the cache
         if isinstance(self.filename, basestring):
             fp = file(self.filename, 'rb')
-            content = fp.read()
-            fp.close()
+            try:
+                return super(PDFGenerator, self).store_in_cache(fp)
+            finally:
+                fp.close()
         elif hasattr(self.filename, 'read') and callable(self.filename.read):
-            content = self.filename.read()
+            # Reads the file object from its start, keeping it at its end
+            if hasattr(self.filename, 'seek'):
+                self.filename.seek(0)
+            try:
+                return super(PDFGenerator, self).store_in_cache(self.filename)
+            finally:
+                if hasattr(self.filename, 'seek'):
+                    self.filename.seek(0, 2)
         else:
             return False
 
-        return super(PDFGenerator, self).store_in_cache(content)
-
     def start_canvas(self, filename=None):
         """Sets the PDF canvas"""
 
@@ -210,6 +707,12 @@ class PDFGenerator(ReportGenerator):
         for r in readers: del r
         del output
 
+        # Removes temporary files made by parallel processes or caching by page
+        if self.parallel_processes or (self.cache_enabled and
+                self.report.cache_status == CACHE_BY_PAGE):
+            for f_name in self.temp_files:
+                os.remove(f_name)
+
     def start_pdf(self):
         """Initializes the PDF document with some properties and methods"""
         # Set PDF properties
@@ -270,7 +773,11 @@ class PDFGenerator(ReportGenerator):
         return ret
 
     def make_paragraph(self, text, style=None):
-        """Uses the Paragraph class to return a new paragraph object"""
+        """Uses the Paragraph class to return a new paragraph object, or the
+        PlainParagraph class if the text has no markup"""
+        if style is not None and is_plain_text(text, style):
+            return PlainParagraph(text, style)
+
         return Paragraph(text, style)
 
     def wrap_paragraph_on(self, paragraph, width, height):
@@ -285,35 +792,35 @@ class PDFGenerator(ReportGenerator):
 
     def set_fill_color(self, color):
         """Sets the current fill on canvas. Used for fonts and shape fills"""
-        self.canvas.setFillColor(color)
+        if self._canvas_state.changes(self.canvas, 'fill_color', color):
+            self.canvas.setFillColor(color)
     
     def set_stroke_color(self, color):
         """Sets the current stroke on canvas"""
-        self.canvas.setStrokeColor(color)
+        if self._canvas_state.changes(self.canvas, 'stroke_color', color):
+            self.canvas.setStrokeColor(color)
 
     def set_stroke_width(self, width):
         """Sets the stroke/line width for shapes"""
-        self.canvas.setLineWidth(width)
-
-    def make_paragraph_style(self, band, style=None):
-        """Merge report default_style + band default_style + widget style"""
-        d_style = self.report.default_style.copy()
-
-        if band.default_style:
-            for k,v in band.default_style.items():
-                d_style[k] = v
+        if self._canvas_state.changes(self.canvas, 'stroke_width', width):
+            self.canvas.setLineWidth(width)
 
-        if style:
-            for k,v in style.items():
-                d_style[k] = v
-
-        return ParagraphStyle(name=datetime.datetime.now().strftime('%H%M%S'), **d_style)
+    def new_paragraph_style(self, d_style, number):
+        """Returns a new paragraph style for the merged style dictionary"""
+        return ParagraphStyle(name='style-%d'%number, **d_style)
 
     def keep_in_frame(self, widget, width, height, paragraphs, mode, persistent=False):
+        plain_paragraphs = [para for para in paragraphs if isinstance(para, PlainParagraph)]
+        paragraphs = [isinstance(para, PlainParagraph) and para.get_paragraph() or para
+                for para in paragraphs]
         keep = KeepInFrame(width, height, paragraphs, mode=mode)
         keep.canv = self.canvas
         keep.wrap(self.calculate_size(widget.width), self.calculate_size(widget.height))
 
+        # Plain paragraphs get the size of the paragraphs wrapped in their place
+        for para in plain_paragraphs:
+            para.width, para.height = para.paragraph.width, para.paragraph.height
+
         if persistent:
             widget.keep = keep
 
@@ -326,7 +833,14 @@ class PDFGenerator(ReportGenerator):
         """Specific method that generates the pages"""
         self._generation_datetime = datetime.datetime.now()
 
-        for num, page in enumerate([page for page in self._rendered_pages if page.elements]):
+        if self.parallel_processes:
+            return self.generate_pages_in_parallel()
+
+        if self.multiple_canvas and self.cache_enabled and\
+           self.report.cache_status == CACHE_BY_PAGE:
+            return self.generate_pages_by_cache()
+
+        for num, page in enumerate([page for page in self._rendered_pages if not page.is_empty()]):
             self._current_page_number = num + 1
 
             # Multiple canvas support (closes current and creates a new
@@ -336,44 +850,347 @@ class PDFGenerator(ReportGenerator):
                 del self.canvas
                 self.start_canvas()
 
-            # Loop at band widgets
-            for element in page.elements:
-                # Widget element
-                if isinstance(element, Widget):
-                    widget = element
-    
-                    # Set element colors
-                    self.set_fill_color(widget.font_color)
-    
-                    self.generate_widget(widget, self.canvas, num)
-    
-                # Graphic element
-                elif isinstance(element, Graphic):
-                    graphic = element
-    
-                    # Set element colors
-                    self.set_fill_color(graphic.fill_color)
-                    self.set_stroke_color(graphic.stroke_color)
-                    self.set_stroke_width(graphic.stroke_width)
-    
-                    self.generate_graphic(graphic, self.canvas)
-
-            self.canvas.showPage()
+            self.generate_page(page, num)
 
         # Multiple canvas support (closes the current one)
         if self.multiple_canvas:
             self.close_current_canvas()
             del self.canvas
 
+    def generate_pages_by_cache(self):
+        """Generates each page in its own PDF, stored in the cache by the hash key of
+        the page. Pages found in the cache are not generated again. Each page is kept
+        in a temporary file until they are combined in the same order by
+        'combine_multiple_canvas'.
+
+        Events of widgets and graphics are not called for pages found in the cache."""
+        cache = self.get_cache_backend()
+        pages = [page for page in self._rendered_pages if not page.is_empty()]
+
+        # The canvas used to render is not used to generate
+        self.temp_files = []
+        del self.canvas
+
+        for num, page in enumerate(pages):
+            self._current_page_number = num + 1
+
+            filename = os.path.join(self.temp_directory, self.temp_file_name%('c%d'%num))
+            self.temp_files.append(filename)
+
+            hash_key = self.get_page_hash_key(page, num, len(pages))
+            content = cache.get_stream(hash_key)
+
+            if content is None:
+                self.canvas = Canvas(filename=filename, pagesize=self.report.page_size)
+                self.start_pdf()
+                self.generate_page(page, num)
+                self.close_current_canvas()
+                del self.canvas
+
+                content = file(filename, 'rb')
+                try:
+                    cache.set_stream(hash_key, content)
+                finally:
+                    content.close()
+            else:
+                fp = file(filename, 'wb')
+                try:
+                    shutil.copyfileobj(content, fp, STREAM_CHUNK_SIZE)
+                finally:
+                    fp.close()
+                    content.close()
+
+    def get_page_hash_key(self, page, num, page_count):
+        """Returns the hash key of a rendered page, considering also its number and,
+        if it has system fields showing it, the page count. So, adding pages doesn't
+        change the hash keys of the previous ones without the page count."""
+        uses_page_count = False
+
+        # System fields texts must be the ones of this page
+        for element in page.elements:
+            if isinstance(element, SystemField):
+                self.set_system_fields(element, num)
+                uses_page_count = uses_page_count or element.uses_page_count()
+
+        hash_key = '%s-%d'%(make_hash_key(self.report, [page]), num + self.first_page_number)
+
+        if uses_page_count:
+            hash_key = '%s-%d'%(hash_key, page_count)
+
+        return hash_key + '.pdf'
+
+    def generate_pages_in_parallel(self):
+        """Generates chunks of pages ('temp_files_max_pages' pages each one) in
+        parallel processes, each one in a temporary file. They are combined in the
+        same order by 'combine_multiple_canvas'.
+
+        Each process is forked just once, to generate its share of chunks, and finds
+        the rendered pages in memory, instead of receiving them pickled. Events of
+        widgets and graphics are called in the processes, so changes they make are
+        not seen by this one."""
+
+        # Empty pages are not generated, like in 'generate_pages'
+        self._parallel_pages = [page for page in self._rendered_pages if not page.is_empty()]
+
+        pages_count = len(self._parallel_pages)
+        chunks = []
+        for start in range(0, pages_count, self.temp_files_max_pages):
+            filename = os.path.join(self.temp_directory, self.temp_file_name%('p%d'%len(chunks)))
+            chunks.append((start, min(start + self.temp_files_max_pages, pages_count), filename))
+
+        # The canvas used to render is not used to generate
+        self.temp_files = []
+
+        # Spooled pages are read by processes from the spool file
+        if self._spool:
+            self._spool.file.flush()
+
+        processes = min(self.parallel_processes, len(chunks))
+        try:
+            if processes:
+                run_in_new_processes(self.generate_pages_chunks,
+                        [((chunks[num::processes],), {}) for num in range(processes)])
+        finally:
+            self._parallel_pages = None
+
+        self.temp_files = [filename for start, end, filename in chunks]
+
+        del self.canvas
+
+    def generate_pages_chunks(self, chunks):
+        """Generates the chunks of pages informed as (start, end, filename) tuples.
+        Runs in a parallel process."""
+        if self._spool:
+            self._spool.reopen()
+
+        for start, end, filename in chunks:
+            self.generate_pages_chunk(start, end, filename)
+
+    def generate_pages_chunk(self, start, end, filename):
+        """Generates the pages from 'start' until 'end' (excluding) in a canvas saved
+        to the informed filename. Runs in a parallel process."""
+        self.canvas = Canvas(filename=filename, pagesize=self.report.page_size)
+        self.start_pdf()
+
+        for num in range(start, end):
+            self._current_page_number = num + 1
+            self.generate_page(self._parallel_pages[num], num)
+
+        self.close_current_canvas()
+
+        return filename
+
+    def generate_page(self, page, num):
+        """Generates the elements of a rendered page on canvas and finishes it"""
+        self._text_batch = TextBatch(self.canvas)
+
+        # A new page starts with the default state
+        self._canvas_state.reset()
+
+        elements = page.elements
+        if self.sort_elements:
+            elements = sort_by_drawing_state(elements)
+
+        if self.static_forms:
+            elements = self.group_static_elements(elements)
+
+        try:
+            for element in elements:
+                # Runs of static elements are drawn in forms
+                if isinstance(element, list):
+                    self.generate_static_elements(element, num)
+                else:
+                    self.generate_element(element, num)
+
+            self.flush_text_batch()
+        finally:
+            self._text_batch = None
+
+        self.canvas.showPage()
+
+    def generate_element(self, element, page_number):
+        """Generates a widget or graphic element of a page on canvas"""
+        # Widget element
+        if isinstance(element, Widget):
+            widget = element
+
+            # Set element colors
+            self.set_fill_color(widget.font_color)
+
+            self.generate_widget(widget, self.canvas, page_number)
+
+        # Graphic element
+        elif isinstance(element, Graphic):
+            graphic = element
+
+            # Texts are drawn before, to keep them under the graphic
+            self.flush_text_batch()
+
+            # Set element colors
+            self.set_fill_color(graphic.fill_color)
+            self.set_stroke_color(graphic.stroke_color)
+            self.set_stroke_width(graphic.stroke_width)
+
+            self.generate_graphic(graphic, self.canvas)
+
+    def get_static_bands(self):
+        """Returns the ids of the bands drawn on every page (page header and footer,
+        and their child bands)"""
+        if self._static_bands is None:
+            self._static_bands = set()
+            bands = [self.report.band_page_header, self.report.band_page_footer]
+
+            while bands:
+                band = bands.pop()
+
+                if band is not None and id(band) not in self._static_bands:
+                    self._static_bands.add(id(band))
+                    bands.extend(band.child_bands or [])
+
+        return self._static_bands
+
+    def group_static_elements(self, elements):
+        """Returns the page elements with the sequences of static elements of the same
+        page header or footer band grouped in lists"""
+        static_bands = self.get_static_bands()
+        if not static_bands:
+            return elements
+
+        ret = []
+        last_band = None
+
+        for element in elements:
+            band = getattr(element, 'band', None)
+
+            if id(band) in static_bands and is_static_element(element):
+                if band is last_band:
+                    ret[-1].append(element)
+                else:
+                    ret.append([element])
+                    last_band = band
+            else:
+                ret.append(element)
+                last_band = None
+
+        return ret
+
+    def generate_static_elements(self, elements, page_number):
+        """Draws static elements as a PDF form. The form is defined on canvas just
+        the first time they are found, and the next pages just reference it"""
+        key = tuple([get_static_key(element) for element in elements])
+        name = self._static_forms.get(key, None)
+
+        if name is None:
+            name = self._static_forms[key] = '%sStatic%d'%(self._forms_prefix,
+                    len(self._static_forms))
+
+        # Texts before them are drawn first, to keep the order
+        self.flush_text_batch()
+
+        if not self.canvas.hasForm(name):
+            self.canvas.beginForm(name)
+            self._canvas_state.reset()
+
+            for element in elements:
+                self.generate_element(element, page_number)
+
+            self.flush_text_batch()
+            self.canvas.endForm()
+            self._canvas_state.reset()
+
+        self.canvas.doForm(name)
+
+    def flush_text_batch(self):
+        """Draws the plain texts of the page waiting to be drawn"""
+        if self._text_batch is not None:
+            self._text_batch.flush()
+
+    # Streaming pages
+
+    def append_new_page(self):
+        # On streaming mode, the finished pages are generated before starting a new one
+        if self.stream_pages:
+            self.generate_rendered_pages()
+
+        super(PDFGenerator, self).append_new_page()
+
+    def generate_rendered_pages(self):
+        """Generates the pages rendered until now on canvas and releases them. Used
+        only on streaming mode."""
+
+        # Keeps the page number used by rendering
+        current_page_number = self._current_page_number
+
+        for page in self._rendered_pages:
+            # Empty pages are not generated, like in 'generate_pages'
+            if page.is_empty():
+                continue
+
+            self._current_page_number = self._streamed_pages_count + 1
+            self.generate_page(page, self._streamed_pages_count)
+            self._streamed_pages_count += 1
+
+            # Releases page elements (deferred widgets can still reference the page)
+            page.clear()
+
+        self._rendered_pages = []
+        self._spooled_pages_index = 0
+        self._current_page_number = current_page_number
+
+    def get_page_count(self):
+        if self.stream_pages:
+            # Empty pages are not counted, but the current one (the last) is, while
+            # it is being rendered
+            pages = [page for page in self._rendered_pages[:-1] if not page.is_empty()]
+            return self._streamed_pages_count + len(pages) + len(self._rendered_pages[-1:])
+
+        return super(PDFGenerator, self).get_page_count()
+
+    def defer_widget(self, widget, canvas, page_number):
+        """Draws a placeholder for a widget that depends on the page count. It is a
+        PDF form, defined just at the end by 'generate_deferred_widgets'"""
+        self.flush_text_batch()
+
+        name = '%sDeferred%d'%(self._forms_prefix, len(self._deferred_widgets))
+        canvas.doForm(name)
+
+        self._deferred_widgets.append((name, widget, page_number))
+
+    def generate_deferred_widgets(self):
+        """Defines the forms for widgets depending on the page count, now it is known"""
+        deferred, self._deferred_widgets = self._deferred_widgets, None
+
+        for name, widget, page_number in deferred:
+            self.canvas.beginForm(name)
+            self._canvas_state.reset()
+            self.set_fill_color(widget.font_color)
+            self.generate_widget(widget, self.canvas, page_number)
+            self.canvas.endForm()
+            self._canvas_state.reset()
+
+    def set_system_fields(self, widget, page_number):
+        """Sets the values of system fields for the page"""
+        widget.fields['report_title'] = self.report.title
+        widget.fields['page_number'] = page_number + 1
+        widget.fields['page_count'] = self.get_page_count()
+        widget.fields['current_datetime'] = self._generation_datetime
+        widget.fields['report_author'] = self.report.author
+
     def generate_widget(self, widget, canvas=None, page_number=0):
         """Renders a widget element on canvas"""
         if isinstance(widget, SystemField):
-            # Sets system fields
-            widget.fields['report_title'] = self.report.title
-            widget.fields['page_number'] = page_number + 1
-            widget.fields['page_count'] = self.get_page_count()
-            widget.fields['current_datetime'] = self._generation_datetime
-            widget.fields['report_author'] = self.report.author
+            self.set_system_fields(widget, page_number)
+
+            # On streaming mode, the page count is known just at the end
+            if self._deferred_widgets is not None and widget.uses_page_count():
+                self.defer_widget(widget, canvas, page_number)
+                return
+
+        # Events can draw on canvas, so the texts before them are drawn first and
+        # the canvas state is not known after them
+        if widget.before_print or widget.after_print:
+            self.flush_text_batch()
+            self._canvas_state.reset()
 
         # Calls the before_print event
         try:
@@ -387,22 +1204,34 @@ class PDFGenerator(ReportGenerator):
 
         # This includes also the SystemField above
         if isinstance(widget, Label):
-            para = Paragraph(widget.text, self.make_paragraph_style(widget.band, widget.style))
-            para.wrapOn(canvas, widget.width, widget.height)
-
-            if widget.truncate_overflow:
-                keep = self.keep_in_frame(
-                        widget,
-                        self.calculate_size(widget.width),
-                        self.calculate_size(widget.height),
-                        [para],
-                        mode='truncate',
-                        )
-                keep.drawOn(canvas, widget.left, widget.top)
-            elif isinstance(widget, SystemField):
-                para.drawOn(canvas, widget.left, widget.top - para.height)
+            # The paragraph laid out on render is drawn, unless the widget has changed
+            para = widget.get_paragraph()
+
+            if para is None:
+                para = self.make_paragraph(widget.text, self.make_paragraph_style(widget.band, widget.style))
+                para.wrapOn(canvas, widget.width, widget.height)
+
+                if widget.truncate_overflow:
+                    para = self.keep_in_frame(
+                            widget,
+                            self.calculate_size(widget.width),
+                            self.calculate_size(widget.height),
+                            [para],
+                            mode='truncate',
+                            )
+
+            if isinstance(widget, SystemField) and not widget.truncate_overflow:
+                top = widget.top - para.height
+            else:
+                top = widget.top
+
+            # Plain texts are drawn together in a text object of the page
+            if self._text_batch is not None and canvas is self._text_batch.canvas and\
+               isinstance(para, PlainParagraph) and para.is_plain():
+                self._text_batch.add(para, widget.left, top)
             else:
-                para.drawOn(canvas, widget.left, widget.top)
+                self.flush_text_batch()
+                para.drawOn(canvas, widget.left, top)
 
             # Calls the after_print event
             widget.do_after_print(generator=self)
@@ -411,6 +1240,10 @@ class PDFGenerator(ReportGenerator):
         """Renders a graphic element"""
         canvas = canvas or self.canvas
 
+        # Events can draw on canvas, so its state is not known after them
+        if graphic.before_print or graphic.after_print:
+            self._canvas_state.reset()
+
         # Calls the before_print event
         try:
             graphic.do_before_print(generator=self)
@@ -507,23 +1340,5 @@ class PDFGenerator(ReportGenerator):
         if not self.report.additional_fonts:
             return
 
-        for font_family_name, fonts_or_file in self.report.additional_fonts.iteritems():
-            # Supports font family with many styles (i.e: normal, italic, bold, bold-italic, etc.)
-            if isinstance(fonts_or_file, (list, tuple, dict)):
-                for font_item in fonts_or_file:
-                    # List of tuples with format like ('font-name', 'font-file', True/False bold, True/False italic)
-                    if isinstance(font_item, (list, tuple)):
-                        font_name, font_file, is_bold, is_italic = font_item
-                        pdfmetrics.registerFont(TTFont(font_name, font_file))
-                        addMapping(font_family_name, is_bold, is_italic, font_name)
-
-                    # List of dicts with format like {'file': '', 'name': '', 'bold': False, 'italic': False}
-                    elif isinstance(font_item, dict):
-                        pdfmetrics.registerFont(TTFont(font_item['name'], font_item['file']))
-                        addMapping(font_family_name, font_item.get('bold', False),
-                                font_item.get('italic', False), font_item['name'])
-
-            # Old style: font name and file path
-            else:
-                pdfmetrics.registerFont(TTFont(font_family_name, fonts_or_file))
+        register_additional_fonts(self.report.additional_fonts)
 
@@ -57,7 +57,8 @@ class TextGenerator(ReportGenerator):
           As far as we know, escape codes can vary depending of model or printer
           manufacturer (i.e. Epson, Lexmark, HP, etc.). This attribute is useful
           to support this. Defaul is ESC/P2 standard (Epson matrix printers)
-        * 'filename' - is the file path you can inform optionally to save text to.
+        * 'filename' - is the file path (or file object) you can inform optionally
+          to save text to.
         * 'encode_to' - you can inform the coding identifier to force Geraldo to
           encode the output string on it. Example: 'latin-1'
         * 'manual_escape_codes' - a boolean variable that sets escape codes are
@@ -95,50 +96,72 @@ class TextGenerator(ReportGenerator):
     def execute(self):
         super(TextGenerator, self).execute()
 
-        # Calls the before_print event
-        self.report.do_before_print(generator=self)
+        try:
+            # Check the cache
+            if self.cached_before_render():
+                return
 
-        # Render pages
-        self.render_bands()
+            # Calls the before_print event
+            self.report.do_before_print(generator=self)
 
-        # Returns rendered pages
-        if self.return_pages:
-            return self._rendered_pages
- 
-        # Calls the after_render event
-        self.report.do_before_generate(generator=self)
+            # Render pages
+            self.render_bands()
 
-        # Generate the pages
-        text = self.generate_pages()
+            # Returns rendered pages
+            if self.return_pages:
+                return self._rendered_pages
 
-        # Encode
-        if self.encode_to:
-            text = text.encode(self.encode_to)
+            # Check the cache
+            if self.cached_before_generate():
+                return
  
-        # Calls the after_print event
-        self.report.do_after_print(generator=self)
+            # Calls the after_render event
+            self.report.do_before_generate(generator=self)
 
-        # Saves to file or just returns the text
-        if hasattr(self, 'filename'):
-            fp = file(self.filename, 'w')
-            fp.write(text)
-            fp.close()
-        else:
-            return text
+            # Generate the pages
+            text = self.generate_pages()
 
-    def get_hash_key(self, objects):
+            # Encode
+            if self.encode_to:
+                text = text.encode(self.encode_to)
+ 
+            # Calls the after_print event
+            self.report.do_after_print(generator=self)
+
+            # Saves to file or just returns the text
+            if self.filename is None:
+                return text
+            elif isinstance(self.filename, basestring):
+                fp = file(self.filename, 'w')
+                fp.write(text)
+                fp.close()
+            else:
+                self.filename.write(text)
+
+            # Store in the cache
+            if isinstance(text, unicode):
+                text = text.encode('utf-8')
+            self.store_in_cache(text)
+        finally:
+            self.release_cache_lock()
+            self.close_spool()
+            self.clear_caches()
+
+    def get_hash_key(self, objects, fingerprint=None):
         """Appends pdf extension to the hash_key"""
-        return super(TextGenerator, self).get_hash_key(objects) + '.txt'
+        return super(TextGenerator, self).get_hash_key(objects, fingerprint) + '.txt'
 
     def calculate_size(self, size):
         """Uses the function 'calculate_size' to calculate a size"""
         if isinstance(size, basestring):
-            if size.endswith('*cols') or size.endswith('*col'):
-                return int(size.split('*')[0]) * self.character_width
-            elif size.endswith('*rows') or size.endswith('*row'):
-                return int(size.split('*')[0]) * self.row_height
+            return calculate_size(size, {
+                'cols': self.character_width,
+                'col': self.character_width,
+                'rows': self.row_height,
+                'row': self.row_height,
+                })
 
-        return calculate_size(size)
+        return size
 
     def make_paragraph(self, text, style=None): # TODO: make style with basic functions, like alignment, bold, emphasis (italic), etc
         """Uses the Paragraph class to return a new paragraph object"""
@@ -152,19 +175,9 @@ class TextGenerator(ReportGenerator):
         """Do nothing with a barcode"""
         pass
 
-    def make_paragraph_style(self, band, style=None):
-        """Merge report default_style + band default_style + widget style"""
-        d_style = self.report.default_style.copy()
-
-        if band.default_style:
-            for k,v in band.default_style.items():
-                d_style[k] = v
-
-        if style:
-            for k,v in style.items():
-                d_style[k] = v
-
-        return dict(name=datetime.datetime.now().strftime('%H%m%s'), **d_style)
+    def new_paragraph_style(self, d_style, number):
+        """Returns the merged style dictionary, with a name"""
+        return dict(name='style-%d'%number, **d_style)
 
     def keep_in_frame(self, widget, width, height, paragraphs, mode):
         # Doesn't nothing for a while: TODO
@@ -181,7 +194,7 @@ class TextGenerator(ReportGenerator):
         # Escapes
         self.add_escapes_report_start();
 
-        for num, page in enumerate([page for page in self._rendered_pages if page.elements]):
+        for num, page in enumerate([page for page in self._rendered_pages if not page.is_empty()]):
             # Escapes
             self.add_escapes_page_start(num);
 
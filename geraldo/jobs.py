@@ -0,0 +1,255 @@
+"""Jobs functions file. You can use this stuff to generate reports in background,
+by a pool of worker processes, and get them when they are ready.
+
+A job is submitted with a report factory (a report class, a function returning a
+report instance or the full string path to one of them) and its arguments. The
+report is made and generated by a worker process and the output is stored in a
+cache backend, the result store, with the job status. So, any process sharing
+the same result store (i.e. all processes of a web server using the same
+directory) can poll the job status and get its output."""
+
+import os, tempfile, binascii, traceback, shutil
+
+from utils import Pool, WorkerPool, get_object_by_path
+from cache import get_cache_backend, STREAM_CHUNK_SIZE
+import utils
+
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+JOBS_PROCESSES = None # The count of CPUs by default
+JOBS_BACKEND = 'geraldo.cache.FileCacheBackend'
+JOBS_FILE_ROOT = os.path.join(tempfile.gettempdir(), 'geraldo-jobs')
+
+JOB_KEY_PREFIX = 'geraldo-job-'
+
+def make_job_key(job_id, suffix=None):
+    """Returns the key of the job output in the result store, or of another
+    value of the job, like its 'status' or 'error'."""
+    key = JOB_KEY_PREFIX + job_id
+
+    if suffix:
+        key = '%s.%s'%(key, suffix)
+
+    return key
+
+def get_job_backend(backend=None, backend_kwargs=None):
+    """Returns the result store for the backend class path and arguments. The
+    default FileCacheBackend stores the jobs in the directory JOBS_FILE_ROOT."""
+    backend = backend or JOBS_BACKEND
+
+    if backend_kwargs is None:
+        backend_kwargs = {}
+
+        if backend == 'geraldo.cache.FileCacheBackend':
+            backend_kwargs['cache_file_root'] = JOBS_FILE_ROOT
+
+    return get_cache_backend(backend, **backend_kwargs)
+
+def run_job(job_id, factory, args, kwargs, generator_class, generator_kwargs,
+        backend, backend_kwargs):
+    """Makes the report, generates it to a temporary file and stores the output in
+    the result store. This is the function called by the worker processes.
+
+    Errors are stored in the result store too, and the job is set as failed."""
+    store = get_job_backend(backend, backend_kwargs)
+    store.set(make_job_key(job_id, 'status'), JOB_RUNNING)
+
+    output = tempfile.TemporaryFile()
+    try:
+        try:
+            if isinstance(factory, basestring):
+                factory = get_object_by_path(factory)
+
+            report = factory(*args, **kwargs)
+            report.generate_by(generator_class, filename=output, **generator_kwargs)
+
+            output.seek(0)
+            store.set_stream(make_job_key(job_id), output)
+        except Exception:
+            store.set(make_job_key(job_id, 'error'), traceback.format_exc())
+            store.set(make_job_key(job_id, 'status'), JOB_FAILED)
+            return False
+    finally:
+        output.close()
+
+    store.set(make_job_key(job_id, 'status'), JOB_DONE)
+    return True
+
+class JobQueue(object):
+    """A queue of report generation jobs, run by a persistent pool of worker
+    processes. Jobs are run in the current process, when 'submit' is called, if
+    multiprocessing is not available or disabled.
+
+    Attributes:
+
+        * 'processes' - the count of worker processes. Default: JOBS_PROCESSES.
+        * 'backend' - the full string path to the cache backend class used as
+                      result store. Default: JOBS_BACKEND.
+        * 'backend_kwargs' - the arguments to initialize the backend.
+    """
+
+    processes = JOBS_PROCESSES
+    backend = None
+    backend_kwargs = None
+
+    _pool = None
+
+    def __init__(self, processes=None, backend=None, backend_kwargs=None):
+        if processes is not None:
+            self.processes = processes
+
+        self.backend = backend or self.backend or JOBS_BACKEND
+        self.backend_kwargs = backend_kwargs or self.backend_kwargs
+        self._results = {}
+
+    def get_store(self):
+        """Returns the result store"""
+        return get_job_backend(self.backend, self.backend_kwargs)
+
+    def get_pool(self):
+        """Returns the pool of worker processes (a WorkerPool), or None if
+        multiprocessing is not available or disabled."""
+        if not Pool or utils.DISABLE_MULTIPROCESSING:
+            return None
+
+        if self._pool is None:
+            self._pool = WorkerPool(self.processes)
+
+        return self._pool
+
+    def submit(self, factory, args=None, kwargs=None, generator_class=None,
+            generator_kwargs=None):
+        """Submits a job to generate the report returned by 'factory' (called with
+        'args' and 'kwargs') by the generator class (default: PDFGenerator) and
+        returns the job id.
+
+        As the job is sent to a worker process, 'factory' and the arguments must
+        be pickable: report classes and functions declared in modules can be used,
+        as well as their full string paths. Keep in mind querysets are loaded when
+        they are pickled, so if you want to load them in the worker process, make
+        them inside the factory. Jobs that can't be pickled are set as failed
+        when they are submitted."""
+        if generator_class is None:
+            from generators import PDFGenerator
+            generator_class = PDFGenerator
+
+        job_id = binascii.hexlify(os.urandom(16))
+        self.get_store().set(make_job_key(job_id, 'status'), JOB_PENDING)
+
+        job_args = (job_id, factory, tuple(args or ()), kwargs or {}, generator_class,
+                generator_kwargs or {}, self.backend, self.backend_kwargs)
+
+        pool = self.get_pool()
+        if pool is None:
+            run_job(*job_args)
+        elif not utils.is_pickable(job_args):
+            self.set_failed(job_id, "The job can't be sent to a worker process, as the "
+                    "factory or its arguments are not pickable: %r"%(factory,))
+        else:
+            self.forget_finished()
+            self._results[job_id] = pool.run_async(run_job, job_args)
+
+        return job_id
+
+    def set_failed(self, job_id, error):
+        """Stores the error of the job and sets it as failed"""
+        store = self.get_store()
+        store.set(make_job_key(job_id, 'error'), error)
+        store.set(make_job_key(job_id, 'status'), JOB_FAILED)
+
+    def check_result(self, job_id):
+        """Forgets the result of a finished job submitted by this queue. If it
+        failed out of 'run_job' (i.e. the worker couldn't run it), the job is set
+        as failed, as it would be pending forever in the result store."""
+        result = self._results.get(job_id, None)
+
+        if result is None or not result.ready():
+            return
+
+        self._results.pop(job_id, None)
+
+        if not result.successful():
+            try:
+                result.get()
+            except Exception:
+                self.set_failed(job_id, traceback.format_exc())
+
+    def forget_finished(self):
+        """Checks the results of all finished jobs submitted by this queue, so they
+        are not kept when their status is read by other processes"""
+        for job_id in self._results.keys():
+            self.check_result(job_id)
+
+    def get_status(self, job_id):
+        """Returns the status of the job (JOB_PENDING, JOB_RUNNING, JOB_DONE or
+        JOB_FAILED), or None if it is not found in the result store."""
+        self.check_result(job_id)
+
+        return self.get_store().get(make_job_key(job_id, 'status'))
+
+    def get_error(self, job_id):
+        """Returns the traceback of a failed job"""
+        return self.get_store().get(make_job_key(job_id, 'error'))
+
+    def wait(self, job_id, timeout=None):
+        """Waits for a job submitted by this queue to finish and returns its status"""
+        result = self._results.get(job_id, None)
+
+        if result is not None:
+            result.wait(timeout)
+
+        return self.get_status(job_id)
+
+    def fetch(self, job_id, output=None):
+        """Returns the output of a finished job, or None if it is not available. If
+        'output' (a file object) is informed, the output is copied to it in chunks
+        and True is returned."""
+        if self.get_status(job_id) != JOB_DONE:
+            return None
+
+        fp = self.get_store().get_stream(make_job_key(job_id))
+        if fp is None:
+            return None
+
+        try:
+            if output is None:
+                return fp.read()
+
+            shutil.copyfileobj(fp, output, STREAM_CHUNK_SIZE)
+            return True
+        finally:
+            fp.close()
+
+    def discard(self, job_id):
+        """Removes the job output and status from the result store"""
+        store = self.get_store()
+
+        for suffix in (None, 'status', 'error'):
+            store.delete(make_job_key(job_id, suffix))
+
+        self._results.pop(job_id, None)
+
+    def close(self):
+        """Waits the submitted jobs to finish and stops the worker processes"""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+        self._results = {}
+
+# Job queue instances, shared in the same process
+_job_queues = {}
+
+def get_job_queue(processes=None, backend=None, backend_kwargs=None):
+    """Returns a job queue for the arguments, instantiated once for each process,
+    so its pool of workers is shared by the next calls."""
+    key = (os.getpid(), processes, backend, tuple(sorted((backend_kwargs or {}).items())))
+    queue = _job_queues.get(key, None)
+
+    if queue is None:
+        queue = _job_queues[key] = JobQueue(processes, backend, backend_kwargs)
+
+    return queue
@@ -1,9 +1,17 @@
-import sys
+import re, os, operator, traceback
+
+try:
+    import cPickle
+except ImportError:
+    import pickle as cPickle
 
 try:
     import reportlab
 except ImportError:
     cm = 28.346456692913385
+    mm = cm * 0.1
+    inch = 72.0
+    pica = 12.0
     A4 = (595.275590551181, 841.8897637795275)
     black = None
     TA_LEFT, TA_CENTER, TA_RIGHT = 0, 1, 2
@@ -14,12 +22,7 @@ else:
     from reportlab.lib.enums import TA_LEFT, TA_CENTER, TA_RIGHT # Check this also
     from reportlab.lib.colors import black
 
-from exceptions import AttributeNotFound
-
-try:
-    from functools import wraps
-except ImportError:
-    wraps = lambda func: func
+from exceptions import AttributeNotFound, WorkerError
 
 # FLAGS
 
@@ -48,29 +51,308 @@ SYSTEM_FIELD_CHOICES = {
     'report_author': 'Author',
 }
 
-def _get_memoized_value(func, args, kwargs):
-    """Used internally by memoize decorator to get/store function results"""
-    key = (repr(args), repr(kwargs))
-    
-    if not key in func._cache_dict:
-        ret = func(*args, **kwargs)
-        func._cache_dict[key] = ret
+try:
+    import threading
+except ImportError:
+    threading = None
 
-    return func._cache_dict[key]
+# Default maximum count of stored results for each memoized function (or for
+# each instance, for memoized methods)
+MEMOIZE_MAX_SIZE = 1000
 
-def memoize(func):
-    """Decorator that stores function results in a dictionary to be used on the
-    next time that the same arguments were informed."""
+class LRUCache(object):
+    """A dictionary-like cache that discards the least recently used items when
+    it exceeds 'max_size'. The size of each item is 1, unless a 'get_size'
+    function is informed to calculate it (i.e. the length of a string).
 
-    func._cache_dict = {}
+    Keeps the statistics 'hits', 'misses' and 'evictions'. Items are not kept
+    when the cache is pickled."""
 
-    def _inner(*args, **kwargs):
-        return _get_memoized_value(func, args, kwargs)
+    def __init__(self, max_size=MEMOIZE_MAX_SIZE, get_size=None):
+        self.max_size = max_size
+        self.get_size = get_size
+        self.hits = self.misses = self.evictions = 0
+        self._make_lock()
+        self._reset()
 
-    if sys.version.startswith('2.4'):
-        return _inner
-    else:
-        return wraps(func)(_inner)
+    def _make_lock(self):
+        if threading:
+            self._lock = threading.Lock()
+        else:
+            self._lock = None
+
+    def _reset(self):
+        self.size = 0
+        self._items = {}
+        self._root = root = [] # Circular doubly linked list: [prev, next, key, value, size]
+        root[:] = [root, root, None, None, 0]
+
+    def clear(self):
+        """Removes all items, holding the lock, as other threads can be using them"""
+        if self._lock: self._lock.acquire()
+        try:
+            self._reset()
+        finally:
+            if self._lock: self._lock.release()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __getstate__(self):
+        return {'max_size': self.max_size, 'get_size': self.get_size,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._make_lock()
+        self._reset()
+
+    def get(self, key, default=None):
+        """Returns the stored value for the key, setting it as the most recently
+        used one, or the default value if it is not there"""
+        if self._lock: self._lock.acquire()
+        try:
+            link = self._items.get(key, None)
+            if link is None:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+
+            # Moves the link to the end of the list (most recently used)
+            link[0][1], link[1][0] = link[1], link[0]
+            root = self._root
+            link[0], link[1] = root[0], root
+            root[0][1] = root[0] = link
+
+            return link[3]
+        finally:
+            if self._lock: self._lock.release()
+
+    def set(self, key, value):
+        """Stores the value for the key, discarding the least recently used items
+        if the cache is full. Values larger than the cache are not stored (and
+        the other items are kept), returning False."""
+        size = self.get_size and self.get_size(value) or 1
+
+        if self._lock: self._lock.acquire()
+        try:
+            if key in self._items:
+                self._remove(self._items[key])
+
+            if self.max_size is not None and size > self.max_size:
+                return False
+
+            root = self._root
+            link = [root[0], root, key, value, size]
+            root[0][1] = root[0] = link
+            self._items[key] = link
+            self.size += size
+
+            while self.max_size is not None and self.size > self.max_size and self._items:
+                self._remove(root[1])
+                self.evictions += 1
+
+            return True
+        finally:
+            if self._lock: self._lock.release()
+
+    def delete(self, key):
+        """Removes the key from the cache, if it is there"""
+        if self._lock: self._lock.acquire()
+        try:
+            if key in self._items:
+                self._remove(self._items[key])
+        finally:
+            if self._lock: self._lock.release()
+
+    def _remove(self, link):
+        link[0][1], link[1][0] = link[1], link[0]
+        del self._items[link[2]]
+        self.size -= link[4]
+
+def make_memoize_key(args, kwargs):
+    """Returns a key for the arguments, made with their own values if they are
+    hashable or with their representations if they are not"""
+    key = (args, tuple(sorted(kwargs.items())))
+
+    try:
+        hash(key)
+    except TypeError:
+        key = (repr(args), repr(kwargs))
+
+    return key
+
+_NOT_CACHED = object()
+
+# Memoized functions, to have their caches cleared by 'clear_memoize_caches'
+_memoized_functions = []
+
+class memoize(object):
+    """Decorator that stores function results in a LRU cache (see LRUCache) to
+    be used on the next time that the same arguments were informed.
+
+    When it decorates a method, each instance has its own cache, so the stored
+    results are discarded with the instance. The cache is available as the
+    attribute 'cache' of the function (or bound method).
+
+    Can be used with or without arguments:
+
+        @memoize
+        def func(): ...
+
+        @memoize(max_size=100)
+        def func(): ...
+    """
+
+    def __init__(self, func=None, max_size=MEMOIZE_MAX_SIZE, get_size=None):
+        self.max_size = max_size
+        self.get_size = get_size
+        self.cache = LRUCache(max_size, get_size)
+        self.func = None
+
+        if func is not None:
+            self.wrap(func)
+
+    def wrap(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+        self.__module__ = func.__module__
+        self._cache_attr = '_memoize_cache_%s'%func.__name__
+        _memoized_functions.append(self)
+
+    def __call__(self, *args, **kwargs):
+        # Used as "@memoize(max_size=...)"
+        if self.func is None:
+            self.wrap(args[0])
+            return self
+
+        return self.call(self.cache, args, kwargs)
+
+    def call(self, cache, args, kwargs, instance=_NOT_CACHED):
+        """Returns the stored result for the arguments or calls the function to
+        get and store it. The instance (for methods) is not part of the key."""
+        key = make_memoize_key(args, kwargs)
+
+        ret = cache.get(key, _NOT_CACHED)
+        if ret is _NOT_CACHED:
+            if instance is _NOT_CACHED:
+                ret = self.func(*args, **kwargs)
+            else:
+                ret = self.func(instance, *args, **kwargs)
+            cache.set(key, ret)
+
+        return ret
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        return MemoizedMethod(self, instance)
+
+    def get_instance_cache(self, instance):
+        try:
+            return instance.__dict__[self._cache_attr]
+        except KeyError:
+            cache = instance.__dict__[self._cache_attr] = LRUCache(self.max_size, self.get_size)
+            return cache
+
+    def clear(self):
+        self.cache.clear()
+
+class MemoizedMethod(object):
+    """A memoized method bound to an instance, using the instance's cache"""
+
+    def __init__(self, memoized, instance):
+        self.memoized = memoized
+        self.instance = instance
+        self.cache = memoized.get_instance_cache(instance)
+        self.__name__ = memoized.__name__
+        self.__doc__ = memoized.__doc__
+
+    def __call__(self, *args, **kwargs):
+        return self.memoized.call(self.cache, args, kwargs, self.instance)
+
+    def clear(self):
+        self.cache.clear()
+
+def clear_memoize_caches():
+    """Clears the caches of all memoized functions. Caches of memoized methods
+    are discarded with their instances."""
+    for memoized in _memoized_functions:
+        memoized.clear()
+
+def clear_instance_caches(instance):
+    """Clears the caches of the memoized methods of an instance, keeping the ones
+    of other instances and of memoized functions (that can be in use by other
+    threads)"""
+    for key, value in instance.__dict__.items():
+        if key.startswith('_memoize_cache_') and isinstance(value, LRUCache):
+            value.clear()
+
+# Attributes of dictionaries, that are found by getattr() before the keys
+_DICT_ATTRIBUTES = frozenset(dir(dict))
+
+# Accessors compiled by get_attr_getter, by attribute path
+_attr_getters = {}
+
+def get_attr_getter(attr_path):
+    """Returns a function that gets the value of the attribute path from an
+    object, like get_attr_value does. The path is split just once and the
+    function is stored to be used on the next time the same path is informed,
+    because this is called for every widget, group and object on reports.
+
+    Example:
+
+        >>> getter = get_attr_getter('customer.name.lower')
+        >>> getter(obj)
+    """
+    try:
+        return _attr_getters[attr_path]
+    except KeyError:
+        pass
+
+    if not attr_path:
+        raise Exception('Invalid attribute path \'%s\''%attr_path)
+
+    parts = tuple(attr_path.split('.'))
+    if len(parts) > 1 and not parts[-1]:
+        raise Exception('Invalid attribute path \'%s\''%parts[-1])
+
+    def getter(obj):
+        val = obj
+        for part in parts:
+            # Fast path for dictionaries, that are the most common non-model objects
+            if type(val) is dict and part not in _DICT_ATTRIBUTES:
+                try:
+                    val = val[part]
+                except KeyError:
+                    raise AttributeNotFound('There is no attribute nor key "%s" in the object "%s"'%(part, repr(val)))
+                continue
+
+            try:
+                val = getattr(val, part)
+            except AttributeError:
+                try:
+                    val = val[part]
+                except (KeyError, TypeError):
+                    raise AttributeNotFound('There is no attribute nor key "%s" in the object "%s"'%(part, repr(val)))
+
+        # Methods with no arguments are called (once for each path part, like
+        # get_attr_value always did)
+        for part in parts:
+            if not callable(val):
+                break
+            val = val()
+
+        return val
+
+    _attr_getters[attr_path] = getter
+    return getter
 
 def get_attr_value(obj, attr_path):
     """This function gets an attribute value from an object. If the attribute
@@ -84,40 +366,194 @@ def get_attr_value(obj, attr_path):
         attribute_name = 'name.upper'
         attribute_name = 'customer.name.lower'
     """
-    if not attr_path:
-        raise Exception('Invalid attribute path \'%s\''%attr_path)
+    return get_attr_getter(attr_path)(obj)
+
+# Units available to size expressions, like '10*cm' or '2.5*inch'
+SIZE_UNITS = {'cm': cm, 'mm': mm, 'inch': inch, 'pica': pica}
+
+EXP_SIZE_TOKENS = re.compile(r'\s*(?:(\d+\.\d*|\.\d+|\d+)|([A-Za-z_]\w*)|(\*\*|[-+*/()]))')
+
+SIZE_OPERATORS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.div, # Classic division, the same eval() always did
+    '**': operator.pow,
+    }
+
+class SizeExpressionParser(object):
+    """Parses size expressions with numbers, units, other names (variables
+    informed when the expression is calculated, like 'rows' and 'cols' on text
+    generator), operators + - * / ** and parenthesis. The result is a function
+    that receives the variables dictionary."""
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.variables = set()
+        self.tokens = self.tokenize(expression)
+        self.pos = 0
+
+    def tokenize(self, expression):
+        tokens = []
+        pos = 0
+        expression = expression.rstrip()
+
+        while pos < len(expression):
+            m = EXP_SIZE_TOKENS.match(expression, pos)
+            if not m or m.end() == pos:
+                raise ValueError('Invalid size expression \'%s\''%self.expression)
 
-    parts = attr_path.split('.')
+            number, name, op = m.groups()
+            if number is not None and '.' in number:
+                tokens.append(('number', float(number)))
+            elif number is not None:
+                tokens.append(('number', int(number)))
+            elif name is not None:
+                tokens.append(('name', name))
+            else:
+                tokens.append(('op', op))
 
+            pos = m.end()
+
+        return tokens
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise ValueError('Invalid size expression \'%s\''%self.expression)
+        self.pos += 1
+        return token
+
+    def parse(self):
+        func = self.parse_sum()
+        if self.pos < len(self.tokens):
+            raise ValueError('Invalid size expression \'%s\''%self.expression)
+        return func
+
+    def parse_binary(self, operators, parse_operand):
+        func = parse_operand()
+
+        while self.peek()[0] == 'op' and self.peek()[1] in operators:
+            op = SIZE_OPERATORS[self.next()[1]]
+            func = self.make_operation(op, func, parse_operand())
+
+        return func
+
+    def parse_sum(self):
+        return self.parse_binary(('+','-'), self.parse_product)
+
+    def parse_product(self):
+        return self.parse_binary(('*','/'), self.parse_unary)
+
+    def parse_unary(self):
+        if self.peek() in (('op','-'), ('op','+')):
+            sign = self.next()[1]
+            func = self.parse_unary()
+            if sign == '-':
+                return lambda variables: -func(variables)
+            return func
+
+        return self.parse_power()
+
+    def parse_power(self):
+        func = self.parse_atom()
+
+        if self.peek() == ('op', '**'):
+            self.next()
+            func = self.make_operation(operator.pow, func, self.parse_unary())
+
+        return func
+
+    def parse_atom(self):
+        typ, value = self.next()
+
+        if typ == 'number':
+            return lambda variables: value
+
+        elif typ == 'name':
+            if value in SIZE_UNITS:
+                unit = SIZE_UNITS[value]
+                return lambda variables: unit
+
+            self.variables.add(value)
+            def get_variable(variables):
+                try:
+                    return variables[value]
+                except (KeyError, TypeError):
+                    raise NameError('name \'%s\' is not defined'%value)
+            return get_variable
+
+        elif (typ, value) == ('op', '('):
+            func = self.parse_sum()
+            if self.next() != ('op', ')'):
+                raise ValueError('Invalid size expression \'%s\''%self.expression)
+            return func
+
+        raise ValueError('Invalid size expression \'%s\''%self.expression)
+
+    def make_operation(self, op, left, right):
+        return lambda variables: op(left(variables), right(variables))
+
+# Compiled size expressions, by expression string
+_compiled_sizes = {}
+
+def compile_size(expression):
+    """Returns a function that calculates the size expression informed, receiving
+    an optional dictionary with variables. The function has an attribute
+    'variables' with the names it depends on. Expressions with no variables are
+    calculated just once. This replaces 'eval', so nothing but sizes can be
+    calculated from the expression string."""
     try:
-        val = getattr(obj, parts[0])
-    except AttributeError:
-        try:
-            val = obj[parts[0]]
-        except (KeyError, TypeError):
-            raise AttributeNotFound('There is no attribute nor key "%s" in the object "%s"'%(parts[0], repr(obj)))
+        return _compiled_sizes[expression]
+    except KeyError:
+        pass
 
-    if len(parts) > 1:
-        val = get_attr_value(val, '.'.join(parts[1:]))
+    parser = SizeExpressionParser(expression)
+    func = parser.parse()
 
-    if callable(val):
-        val = val()
-        
-    return val
+    if not parser.variables:
+        value = func(None)
+        func = lambda variables=None: value
+    else:
+        func = lambda variables=None, func=func: func(variables)
 
-@memoize
-def calculate_size(size):
+    func.variables = tuple(parser.variables)
+
+    _compiled_sizes[expression] = func
+    return func
+
+def calculate_size(size, variables=None):
     """Calculates the informed size. If this is a string or unicode, it is
-    converted to float using evaluation function"""
+    a size expression like '10*cm' or '15.8*rows', converted to float (see
+    compile_size). The argument 'variables' is a dictionary with values for
+    names that are not units, like 'rows'."""
     if isinstance(size, basestring):
-        return eval(size) # If you are thinking this is a semanthic bug, you must
-                          # be aware this 'eval' is necessary to calculate sizes
-                          # like '10*cm' or '15.8*rows'
-                          # I want to check if eval is better way to do it than
-                          # do a regex matching and calculate. TODO
-    
+        return compile_size(size)(variables)
+
     return size
 
+def resolve_size(size):
+    """Returns the size calculated if it is an expression with no variables, or
+    the same size if it can't be calculated now (i.e. flags like BAND_WIDTH and
+    expressions depending on the generator, like '10*rows')."""
+    if not isinstance(size, basestring):
+        return size
+
+    try:
+        func = compile_size(size)
+    except ValueError:
+        return size
+
+    if func.variables:
+        return size
+
+    return func()
+
 # Replaced by ReportLab landscape and portrait functions
 #@memoize
 #def landscape(page_size):
@@ -130,30 +566,232 @@ def format_date(date, expression):
 # Tries to import class Process from multiprocessing library and sets
 # it as None if import fails
 try:
-    from multiprocessing import Process
+    from multiprocessing import Process, Pool, Pipe, current_process
 except ImportError:
-    Process = None
+    Process = Pool = Pipe = current_process = None
 
 # Sets this to True if you don't want to use multiprocessing on
 # functions with 'run_under_process' decorator
 DISABLE_MULTIPROCESSING = False
 
+# Settings of the worker pool used by 'run_under_process': count of processes
+# (None for the count of CPUs), count of tasks a worker runs before be replaced
+# by a new one, and additional fonts (in the same format of report attribute
+# 'additional_fonts') registered when the workers start
+WORKER_POOL_PROCESSES = None
+WORKER_POOL_MAX_TASKS = 50
+WORKER_POOL_FONTS = None
+
+# Is True inside the worker processes
+IN_WORKER_PROCESS = False
+
+def get_object_by_path(path):
+    """Imports and returns the object (i.e. a class or a function) from its full
+    string path, like 'geraldo.cache.FileCacheBackend'."""
+    parts = path.split('.')
+    module = __import__('.'.join(parts[:-1]), fromlist=[parts[-1]])
+
+    return getattr(module, parts[-1])
+
+def in_worker_process():
+    """Returns True inside the worker processes, or any daemonic process (i.e.
+    workers of other multiprocessing pools), where processes can't be started"""
+    return IN_WORKER_PROCESS or bool(current_process and current_process().daemon)
+
+def is_pickable(*values):
+    try:
+        cPickle.dumps(values, cPickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return False
+
+    return True
+
+def initialize_worker(additional_fonts=None):
+    """Called when a worker process starts. Imports the generators (and then
+    ReportLab) and registers the additional fonts, so they are ready for the
+    reports the worker will generate."""
+    global IN_WORKER_PROCESS
+    IN_WORKER_PROCESS = True
+
+    from generators import pdf
+
+    if additional_fonts:
+        pdf.register_additional_fonts(additional_fonts)
+
+def run_in_worker(func, args, kwargs):
+    return func(*args, **kwargs)
+
+def run_pickled_in_worker(pickled_call):
+    func, args, kwargs = cPickle.loads(pickled_call)
+    return func(*args, **kwargs)
+
+def run_in_new_process(func, args, kwargs):
+    """Runs the function in a new process and returns its result, sent back over
+    a pipe. Exceptions are raised again with the child traceback."""
+    return run_in_new_processes(func, [(args, kwargs)])[0]
+
+def run_in_other_process(func, args=(), kwargs=None):
+    """Runs the function in a new process, like 'run_in_new_process', unless
+    multiprocessing is disabled or this is a worker process: then it is just
+    called. Unlike 'run_under_process', the function and arguments are not
+    pickled where processes are forked, so they are not loaded (i.e. querysets)
+    in the current process."""
+    kwargs = kwargs or {}
+
+    if not Process or DISABLE_MULTIPROCESSING or in_worker_process():
+        return func(*args, **kwargs)
+
+    return run_in_new_process(func, args, kwargs)
+
+def run_in_new_processes(func, calls):
+    """Runs the function in a new process for each (args, kwargs) tuple in 'calls',
+    all at the same time, and returns the list of their results, sent back over
+    pipes. If any of them fails, WorkerError is raised with the child traceback.
+
+    Where processes are forked, the function and arguments are not pickled, so
+    they can reference anything in memory."""
+    def target(child_conn, args, kwargs):
+        global IN_WORKER_PROCESS
+        IN_WORKER_PROCESS = True
+
+        try:
+            result = (True, func(*args, **kwargs))
+        except Exception:
+            result = (False, traceback.format_exc())
+
+        child_conn.send(result)
+        child_conn.close()
+
+    running = []
+    finished = False
+    try:
+        for args, kwargs in calls:
+            parent_conn, child_conn = Pipe(False)
+            prc = Process(target=target, args=(child_conn, args, kwargs))
+            prc.start()
+            child_conn.close()
+            running.append((prc, parent_conn))
+
+        results = []
+        for prc, parent_conn in running:
+            try:
+                success, result = parent_conn.recv()
+            except EOFError:
+                success, result = False, 'The process has finished with no result.'
+
+            if not success:
+                raise WorkerError(result)
+
+            results.append(result)
+
+        finished = True
+    finally:
+        for prc, parent_conn in running:
+            parent_conn.close()
+
+            # After a failure, the other processes are not waited for
+            if not finished and prc.is_alive():
+                prc.terminate()
+            prc.join()
+
+    return results
+
+class WorkerPool(object):
+    """A pool of worker processes kept alive to run functions, so the next ones
+    don't pay for starting a process, importing libraries and registering fonts.
+    Each worker is replaced by a new one after running 'max_tasks_per_child'
+    functions (on Python 2.7 or higher), to keep the memory in check.
+
+    Functions and arguments are sent to the workers pickled, so functions must be
+    declared in modules. If they are not pickable, the function is run in a new
+    process, started just for it. Results are sent back over pipes."""
+
+    processes = WORKER_POOL_PROCESSES
+    max_tasks_per_child = WORKER_POOL_MAX_TASKS
+    additional_fonts = WORKER_POOL_FONTS
+
+    _pool = None
+
+    def __init__(self, processes=None, max_tasks_per_child=None, additional_fonts=None):
+        if processes is not None:
+            self.processes = processes
+        if max_tasks_per_child is not None:
+            self.max_tasks_per_child = max_tasks_per_child
+        if additional_fonts is not None:
+            self.additional_fonts = additional_fonts
+
+    def get_pool(self):
+        """Returns the multiprocessing pool, started in the first call"""
+        if self._pool is None:
+            initargs = (self.additional_fonts,)
+
+            try:
+                self._pool = Pool(self.processes, initialize_worker, initargs,
+                        self.max_tasks_per_child or None)
+            except TypeError:
+                # Python 2.6 doesn't support 'maxtasksperchild'
+                self._pool = Pool(self.processes, initialize_worker, initargs)
+
+        return self._pool
+
+    def run(self, func, args=(), kwargs=None):
+        """Runs the function in a worker and returns its result"""
+        kwargs = kwargs or {}
+
+        # The call is pickled just once, here, and sent to the worker as a string
+        try:
+            pickled_call = cPickle.dumps((func, args, kwargs), cPickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return run_in_new_process(func, args, kwargs)
+
+        return self.get_pool().apply(run_pickled_in_worker, (pickled_call,))
+
+    def run_async(self, func, args=(), kwargs=None):
+        """Sends the function to a worker and returns a multiprocessing AsyncResult
+        object. Function and arguments must be pickable."""
+        return self.get_pool().apply_async(run_in_worker, (func, args, kwargs or {}))
+
+    def close(self):
+        """Waits the running functions to finish and stops the workers"""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+# Worker pool instances, shared in the same process
+_worker_pools = {}
+
+def get_worker_pool(processes=None):
+    """Returns the worker pool for the count of processes (default:
+    WORKER_POOL_PROCESSES), instantiated once for each process."""
+    key = (os.getpid(), processes)
+    pool = _worker_pools.get(key, None)
+
+    if pool is None:
+        pool = _worker_pools[key] = WorkerPool(processes)
+
+    return pool
+
 def run_under_process(func):
     """This is a decorator that uses multiprocessing library to run a
-    function under a new process. To use it on Python 2.4 you need to
-    install python-multiprocessing package.
-    
-    Just remember that Process doesn't support returning value"""
+    function under other process, from the worker pool, and returns its
+    result. To use it on Python 2.4 you need to install
+    python-multiprocessing package.
+
+    If the function is declared in a module (so, it is pickable), it is
+    run by a persistent worker. Otherwise it runs in a new process."""
 
     def _inner(*args, **kwargs):
-        # If multiprocessing is disabled, just runs function with
-        # its arguments
-        if not Process or DISABLE_MULTIPROCESSING:
-            func(*args, **kwargs)
+        # If multiprocessing is disabled (or this is already a worker), just
+        # runs function with its arguments
+        if not Process or DISABLE_MULTIPROCESSING or in_worker_process():
+            return func(*args, **kwargs)
 
-        prc = Process(target=func, args=args, kwargs=kwargs)
-        prc.start()
-        prc.join()
+        return get_worker_pool().run(_inner, args, kwargs)
 
-    return _inner
+    # Makes the decorated function pickable by its name
+    _inner.__name__ = func.__name__
+    _inner.__module__ = func.__module__
+    _inner.__doc__ = func.__doc__
 
+    return _inner
@@ -6,10 +6,11 @@ except NameError:
     from sets import Set as set     # Python 2.3 fallback 
 
 from base import BAND_WIDTH, BAND_HEIGHT, Element, SubReport
-from utils import get_attr_value, SYSTEM_FIELD_CHOICES, FIELD_ACTION_VALUE, FIELD_ACTION_COUNT,\
+from utils import get_attr_getter, SYSTEM_FIELD_CHOICES, FIELD_ACTION_VALUE, FIELD_ACTION_COUNT,\
         FIELD_ACTION_AVG, FIELD_ACTION_MIN, FIELD_ACTION_MAX, FIELD_ACTION_SUM,\
         FIELD_ACTION_DISTINCT_COUNT, cm, black
 from exceptions import AttributeNotFound
+from aggregations import AGGREGATION_ACTIONS, EXP_AGGREGATIONS
 
 class Widget(Element):
     """A widget is a value representation on the report"""
@@ -77,10 +78,63 @@ class Label(Widget):
 
         return new
 
+    # The paragraph (or the frame, when truncating overflow) laid out by the
+    # generator on render, to be drawn on generate if nothing changed between
+    _paragraph = None
+    _paragraph_key = None
+
+    def get_paragraph_key(self, text=None):
+        if text is None:
+            text = self.text
+
+        return (text, self.width, self.height, self.truncate_overflow, dict(self.style or {}))
+
+    def set_paragraph(self, paragraph, text=None):
+        self._paragraph = paragraph
+        self._paragraph_key = self.get_paragraph_key(text)
+
+    def get_paragraph(self):
+        """Returns the paragraph laid out on render, or None if the widget has
+        changed after it (i.e. by event 'before_print')"""
+        if self._paragraph is None or self._paragraph_key != self.get_paragraph_key():
+            return None
+
+        return self._paragraph
+
+    def __getstate__(self):
+        # The paragraph is not pickled (i.e. when pages are spooled). It is made
+        # again on generate
+        state = self.__dict__.copy()
+        state.pop('_paragraph', None)
+        state.pop('_paragraph_key', None)
+
+        return state
+
 EXP_QUOTED = re.compile('\w\(([^\'"].+?[^\'"])(|,.*?)\)')
 EXP_QUOTED_SUB = re.compile('\(([^\'"].+?[^\'"])(|,.*?)\)')
 EXP_TOKENS = re.compile('([\w\._]+|\*\*|\+|\-|\*|\/)')
 
+_expression_tokens = {}
+
+def get_expression_tokens(attribute_name):
+    """Returns the attribute names used by an expression like 'price * quantity',
+    or None if the attribute name is not an expression. The result is stored to
+    be used on the next time, because this is called once for each object."""
+    try:
+        return _expression_tokens[attribute_name]
+    except KeyError:
+        pass
+
+    tokens = filter(bool, [token.strip() for token in EXP_TOKENS.split(attribute_name)]) # Cleans empty parts
+    if len(tokens) > 1:
+        names = [token for token in tokens
+                if not token in ('+','-','*','/','**') and not token.isdigit()]
+    else:
+        names = None
+
+    _expression_tokens[attribute_name] = names
+    return names
+
 class ObjectValue(Label):
     """This shows the value from a method, field or property from objects got
     from the queryset.
@@ -147,20 +201,18 @@ class ObjectValue(Label):
                 return self.get_value(instance)
 
         # Checks this is an expression
-        tokens = EXP_TOKENS.split(attribute_name)
-        tokens = filter(bool, tokens) # Cleans empty parts
-        if len(tokens) > 1:
+        tokens = get_expression_tokens(attribute_name)
+        if tokens is not None:
             values = {}
             for token in tokens:
-                if not token in ('+','-','*','/','**') and not  token.isdigit():
-                    values[token] = self.get_object_value(instance, token)
+                values[token] = self.get_object_value(instance, token)
             return eval(attribute_name, values)
 
         # Gets value with function
-        value = get_attr_value(instance, attribute_name)
+        value = get_attr_getter(attribute_name)(instance)
 
         # For method attributes --- FIXME: check what does this code here, because
-        #                           get_attr_value has a code to do that, using
+        #                           get_attr_getter has a code to do that, using
         #                           callable() checking
         if type(value) == types.MethodType:
             value = value()
@@ -174,28 +226,70 @@ class ObjectValue(Label):
         objects = self.generator.get_current_queryset()
         return map(lambda obj: self.get_object_value(obj, attribute_name), objects)
 
-    def _clean_empty_values(self, values):
-        def clean(val):
-            if not val:
-                return 0
-            elif isinstance(val, decimal.Decimal) and self.converts_decimal_to_float:
-                return float(val)
-            elif isinstance(val, float) and self.converts_float_to_decimal:
-                return decimal.Decimal(str(val))
-            
-            return val
+    def get_aggregations(self, streaming=False):
+        """Returns a list of (action, attribute_name) tuples with the aggregations
+        this widget shows, used by the generator to prepare running aggregates.
 
-        return map(clean, values)
+        Widgets with 'get_value' are aggregated just on streaming mode, because
+        the queryset can't be read again to get their values."""
+        if self.get_value:
+            if streaming and self.action in AGGREGATION_ACTIONS:
+                return [(self.action, self.attribute_name)]
+
+            return []
+
+        if self.expression:
+            return EXP_AGGREGATIONS.findall(self.expression)
+
+        if self.action in AGGREGATION_ACTIONS and self.attribute_name:
+            return [(self.action, self.attribute_name)]
+
+        return []
+
+    def get_running_aggregate(self, action, attribute_name=None):
+        """Returns the running aggregate the generator keeps for the attribute in
+        the band being rendered (a group footer or the summary), or None if there
+        is no one, and then the values must be got from the current queryset."""
+        if not self.generator or (self.get_value and not self.generator.report.streaming):
+            return None
+
+        aggregate = self.generator.get_running_aggregate(self, attribute_name or self.attribute_name)
+
+        if aggregate is None or action not in aggregate.actions:
+            return None
+
+        return aggregate
+
+    def _clean_empty_value(self, val):
+        if not val:
+            return 0
+        elif isinstance(val, decimal.Decimal) and self.converts_decimal_to_float:
+            return float(val)
+        elif isinstance(val, float) and self.converts_float_to_decimal:
+            return decimal.Decimal(str(val))
+        
+        return val
+
+    def _clean_empty_values(self, values):
+        return map(self._clean_empty_value, values)
 
     def action_value(self, attribute_name=None):
         return self.get_object_value(attribute_name=attribute_name)
 
     def action_count(self, attribute_name=None):
+        aggregate = self.get_running_aggregate(FIELD_ACTION_COUNT, attribute_name)
+        if aggregate is not None:
+            return aggregate.count
+
         # Returns the total count of objects with valid values on informed attribute
         values = self.get_queryset_values(attribute_name)
         return len(filter(lambda v: v is not None, values))
 
     def action_avg(self, attribute_name=None):
+        aggregate = self.get_running_aggregate(FIELD_ACTION_AVG, attribute_name)
+        if aggregate is not None:
+            return aggregate.avg()
+
         values = self.get_queryset_values(attribute_name)
 
         # Clear empty values
@@ -204,14 +298,26 @@ class ObjectValue(Label):
         return sum(values) / len(values)
 
     def action_min(self, attribute_name=None):
+        aggregate = self.get_running_aggregate(FIELD_ACTION_MIN, attribute_name)
+        if aggregate is not None:
+            return aggregate.min
+
         values = self.get_queryset_values(attribute_name)
         return min(values)
 
     def action_max(self, attribute_name=None):
+        aggregate = self.get_running_aggregate(FIELD_ACTION_MAX, attribute_name)
+        if aggregate is not None:
+            return aggregate.max
+
         values = self.get_queryset_values(attribute_name)
         return max(values)
 
     def action_sum(self, attribute_name=None):
+        aggregate = self.get_running_aggregate(FIELD_ACTION_SUM, attribute_name)
+        if aggregate is not None:
+            return aggregate.sum
+
         values = self.get_queryset_values(attribute_name)
 
         # Clear empty values
@@ -220,6 +326,10 @@ class ObjectValue(Label):
         return sum(values)
 
     def action_distinct_count(self, attribute_name=None):
+        aggregate = self.get_running_aggregate(FIELD_ACTION_DISTINCT_COUNT, attribute_name)
+        if aggregate is not None:
+            return len(aggregate.distinct)
+
         values = filter(lambda v: v is not None, self.get_queryset_values(attribute_name))
         return len(set(values))
 
@@ -348,6 +458,12 @@ class SystemField(Label):
     def text(self): return self._text()
     text = property(text)
 
+    def uses_page_count(self):
+        """Returns True if the text can depend on the page count (that is known just
+        at the end of generation when pages are streamed)"""
+        return bool(self.get_value) or 'page_count' in self.expression or\
+                'last_page_number' in self.expression
+
     def clone(self):
         new = super(SystemField, self).clone()
         new.expression = self.expression
@@ -17,14 +17,17 @@ __version__ = get_version()
 #------------------------------------------------------------
 
 import re, sets, imp
+from urllib import urlencode
 
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseServerError, Http404
 from django.shortcuts import render_to_response
 from django.template import RequestContext
 from django.utils.translation import ugettext as _
 from django.conf import settings
 
 from geraldo.generators import PDFGenerator
+from geraldo.jobs import get_job_queue, JOB_DONE, JOB_FAILED
+from geraldo.utils import get_object_by_path
 
 exp_report = re.compile('^(?P<app>[\w_]+)/(?P<model>[\w_]+)/(?P<name>[\w_-]+)/$')
 
@@ -53,6 +56,17 @@ def autodiscover():
 class ReportSite(object):
     reports = []
 
+    # Set 'asynchronous' to True to generate reports in background, by a pool of
+    # worker processes (see geraldo.jobs). The workers find this site by the full
+    # string path to its instance in 'site_path', so set it if you make your own
+    # site. The reports are made by 'make_report_by_params', as the workers have
+    # no request: 'get_queryset' overrides don't apply, but the ones of
+    # 'get_queryset_by_params' do.
+    asynchronous = False
+    job_queue_kwargs = {}
+    refresh_seconds = 2
+    site_path = 'reporting.site'
+
     def root(self, request, path):
         # Report path
         m = exp_report.match(path)
@@ -74,9 +88,12 @@ class ReportSite(object):
         # Find the registered report for this URL
         registered = self.get_report_by_url(request)
 
+        # Generates in background, returning immediately
+        if self.asynchronous:
+            return self.async_report_view(request, registered, app, model, name)
+
         # Initialize the reponse object
-        resp = HttpResponse(mimetype='application/pdf')
-        resp['Content-Disposition'] = 'filename=%s.pdf'%'-'.join([app, model, name])
+        resp = self.make_response(app, model, name)
 
         # Get the queryset
         queryset = self.get_queryset(request, registered['model'])
@@ -89,6 +106,45 @@ class ReportSite(object):
 
         return resp
 
+    def async_report_view(self, request, registered, app, model, name):
+        """Submits a job to generate the report and redirects to the same URL with
+        the job id, where the report is returned when it is ready. While it is not,
+        a page refreshing itself is returned. Unknown (i.e. expired or discarded)
+        jobs raise Http404."""
+        queue = get_job_queue(**self.job_queue_kwargs)
+        job_id = request.GET.get('job', None)
+
+        if not job_id:
+            params = dict([(str(k),v) for k,v in request.GET.items()])
+            job_id = queue.submit(make_registered_report,
+                    args=(self.site_path, registered['path'], params))
+
+            params['job'] = job_id
+            return HttpResponseRedirect('%s?%s'%(request.path, urlencode(params)))
+
+        status = queue.get_status(job_id)
+
+        if status is None:
+            raise Http404(_('Report generation not found.'))
+        elif status == JOB_DONE:
+            resp = self.make_response(app, model, name)
+            queue.fetch(job_id, resp)
+            queue.discard(job_id)
+            return resp
+        elif status == JOB_FAILED:
+            queue.discard(job_id)
+            return HttpResponseServerError(_('The report generation has failed.'))
+
+        resp = HttpResponse(_('The report is being generated. Please wait...'))
+        resp['Refresh'] = str(self.refresh_seconds)
+        return resp
+
+    def make_response(self, app, model, name):
+        resp = HttpResponse(mimetype='application/pdf')
+        resp['Content-Disposition'] = 'filename=%s.pdf'%'-'.join([app, model, name])
+
+        return resp
+
     def get_adminmodel(self, model):
         from django.contrib.admin import site
         modeladmin = site._registry[model]
@@ -96,20 +152,23 @@ class ReportSite(object):
         return modeladmin
 
     def get_queryset(self, request, model):
+        return self.get_queryset_by_params(request.GET, model)
+
+    def get_queryset_by_params(self, params, model):
         modeladmin = self.get_adminmodel(model)
 
         # Get ordering field and direction
-        if modeladmin and 'o' in request.GET:
-            order = modeladmin.list_display[int(request.GET['o'])]
+        if modeladmin and 'o' in params:
+            order = modeladmin.list_display[int(params['o'])]
 
-            if request.GET.get('ot', None) == 'desc':
+            if params.get('ot', None) == 'desc':
                 order = '-'+order
         else:
             order = None
 
         # Get filters
-        filter = dict([(str(k),v) for k,v in request.GET.items()\
-            if not k in ('o','ot','q','p')])
+        filter = dict([(str(k),v) for k,v in params.items()\
+            if not k in ('o','ot','q','p','job')])
         
         # Get the queryset
         queryset = model.objects.all()
@@ -151,4 +210,18 @@ class ReportSite(object):
     def get_report_by_path(self, path):
         return [report for report in self.reports if report['path'] == path][0]
 
+    def make_report_by_params(self, path, params):
+        """Returns the instance of the report registered with the path, with the
+        queryset filtered by the params."""
+        registered = self.get_report_by_path(path)
+        queryset = self.get_queryset_by_params(params, registered['model'])
+
+        return registered['report'](queryset=queryset)
+
 site = ReportSite()
+
+def make_registered_report(site_path, path, params):
+    """Returns the report made by the site in the full string path 'site_path' for
+    the registered path and params. This is called by the job queue workers, so
+    the queryset is loaded by them."""
+    return get_object_by_path(site_path).make_report_by_params(path, params)